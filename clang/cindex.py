@@ -66,6 +66,7 @@ from ctypes import *
 
 import clang.enumerations
 
+import array
 import os
 import sys
 if sys.version_info[0] == 3:
@@ -364,6 +365,12 @@ class SourceRange(Structure):
     def __repr__(self):
         return "<SourceRange start %r, end %r>" % (self.start, self.end)
 
+class _CXSourceRangeList(Structure):
+    """Helper for the lists of SourceRange allocated by libclang."""
+    _fields_ = [
+        ("count", c_uint),
+        ("ranges", POINTER(SourceRange))]
+
 class Diagnostic(object):
     """
     A Diagnostic is a single instance of a Clang diagnostic. It includes the
@@ -570,6 +577,85 @@ class TokenGroup(object):
 
             yield token
 
+class TokenArrays(object):
+    """The tokens of an extent as parallel arrays instead of Token instances.
+
+    The CXToken buffer returned by libclang is read as a whole: the kinds,
+    file offsets and lengths of the tokens are array.array('I') instances
+    (numpy.frombuffer() gives views of them), and their lines and spellings
+    are computed on first access. All the tokens are from the same file.
+
+    You should not instantiate this class outside of this module, see
+    TranslationUnit.get_token_arrays().
+    """
+    def __init__(self, tu, extent):
+        tokens_memory = POINTER(Token)()
+        tokens_count = c_uint()
+
+        conf.lib.clang_tokenize(tu, extent, byref(tokens_memory),
+                byref(tokens_count))
+
+        self._tu = tu
+        self._count = int(tokens_count.value)
+        self._lines = None
+        self._spellings = None
+        self.file = None
+        self.kinds = array.array('I')
+        self.offsets = array.array('I')
+        self.lengths = array.array('I')
+
+        # If we get no tokens, no memory was allocated.
+        if self._count < 1:
+            return
+
+        self._group = TokenGroup(tu, tokens_memory, tokens_count)
+        self._tokens = cast(tokens_memory, POINTER(Token * self._count)).contents
+
+        # The int_data of a CXToken holds its kind, the raw encoding of its
+        # location and its length. The tokens being lexed from a single file,
+        # their raw locations are their file offsets shifted by the same base.
+        words = array.array('I')
+        words.frombytes(string_at(tokens_memory, sizeof(Token) * self._count))
+        stride = sizeof(Token) // words.itemsize
+        self.kinds = words[0::stride]
+        self.lengths = words[2::stride]
+        start = conf.lib.clang_getTokenLocation(tu, self._tokens[0])
+        self.file = start.file
+        base = words[1] - start.offset
+        self.offsets = array.array('I', [raw - base for raw in words[1::stride]])
+
+    def __len__(self):
+        return self._count
+
+    @property
+    def lines(self):
+        """The lines of the tokens, as an array.array('I')."""
+        if self._lines is None:
+            lines = array.array('I')
+            if self._count:
+                size = c_size_t()
+                contents = conf.lib.clang_getFileContents(self._tu, self.file,
+                        byref(size))
+                source = string_at(contents, size.value)
+                line = 1
+                previous = 0
+                for offset in self.offsets:
+                    line += source.count(b'\n', previous, offset)
+                    previous = offset
+                    lines.append(line)
+            self._lines = lines
+
+        return self._lines
+
+    @property
+    def spellings(self):
+        """The spellings of the tokens, as a list of strings."""
+        if self._spellings is None:
+            self._spellings = [conf.lib.clang_getTokenSpelling(self._tu, t)
+                               for t in self._tokens] if self._count else []
+
+        return self._spellings
+
 class TokenKind(object):
     """Describes a specific type of a Token."""
 
@@ -668,41 +754,68 @@ class CursorKind(BaseEnumeration):
         """Return all CursorKind enumeration instances."""
         return [x for x in CursorKind._kinds if not x is None]
 
+    # The is_*() predicates are answered from a table of bitmasks indexed by
+    # the kind values, built on first use as the set of kinds is fixed.
+    _predicates = ('clang_isDeclaration', 'clang_isReference',
+                   'clang_isExpression', 'clang_isStatement',
+                   'clang_isAttribute', 'clang_isInvalid',
+                   'clang_isTranslationUnit', 'clang_isPreprocessing',
+                   'clang_isUnexposed')
+    _masks = None
+
+    @staticmethod
+    def _build_masks():
+        masks = [None] * len(CursorKind._kinds)
+        for kind in CursorKind.get_all_kinds():
+            mask = 0
+            for bit, name in enumerate(CursorKind._predicates):
+                if getattr(conf.lib, name)(kind):
+                    mask |= 1 << bit
+            masks[kind.value] = mask
+        return tuple(masks)
+
+    def _mask(self):
+        masks = CursorKind._masks
+        if masks is None or self.value >= len(masks) or masks[self.value] is None:
+            # first use, or kinds registered since the table was built
+            masks = CursorKind._masks = CursorKind._build_masks()
+        return masks[self.value]
+
     def is_declaration(self):
         """Test if this is a declaration kind."""
-        return conf.lib.clang_isDeclaration(self)
+        return self._mask() & 1 != 0
 
     def is_reference(self):
         """Test if this is a reference kind."""
-        return conf.lib.clang_isReference(self)
+        return self._mask() & 2 != 0
 
     def is_expression(self):
         """Test if this is an expression kind."""
-        return conf.lib.clang_isExpression(self)
+        return self._mask() & 4 != 0
 
     def is_statement(self):
         """Test if this is a statement kind."""
-        return conf.lib.clang_isStatement(self)
+        return self._mask() & 8 != 0
 
     def is_attribute(self):
         """Test if this is an attribute kind."""
-        return conf.lib.clang_isAttribute(self)
+        return self._mask() & 16 != 0
 
     def is_invalid(self):
         """Test if this is an invalid kind."""
-        return conf.lib.clang_isInvalid(self)
+        return self._mask() & 32 != 0
 
     def is_translation_unit(self):
         """Test if this is a translation unit kind."""
-        return conf.lib.clang_isTranslationUnit(self)
+        return self._mask() & 64 != 0
 
     def is_preprocessing(self):
         """Test if this is a preprocessing kind."""
-        return conf.lib.clang_isPreprocessing(self)
+        return self._mask() & 128 != 0
 
     def is_unexposed(self):
         """Test if this is an unexposed kind."""
-        return conf.lib.clang_isUnexposed(self)
+        return self._mask() & 256 != 0
 
     def __repr__(self):
         return 'CursorKind.%s' % (self.name,)
@@ -1434,6 +1547,10 @@ class Cursor(Structure):
     def __ne__(self, other):
         return not self.__eq__(other)
 
+    def __hash__(self):
+        # clang_hashCursor() is consistent with clang_equalCursors().
+        return self.hash
+
     def is_definition(self):
         """
         Returns true if the declaration pointed at by the cursor is also a
@@ -1516,7 +1633,10 @@ class Cursor(Structure):
         """
         # TODO: Should probably check that this is either a reference or
         # declaration prior to issuing the lookup.
-        return conf.lib.clang_getCursorDefinition(self)
+        if not hasattr(self, '_definition'):
+            self._definition = conf.lib.clang_getCursorDefinition(self)
+
+        return self._definition
 
     def get_usr(self):
         """Return the Unified Symbol Resolution (USR) for the entity referenced
@@ -1527,7 +1647,10 @@ class Cursor(Structure):
         program. USRs can be compared across translation units to determine,
         e.g., when references in one translation refer to an entity defined in
         another translation unit."""
-        return conf.lib.clang_getCursorUSR(self)
+        if not hasattr(self, '_usr'):
+            self._usr = conf.lib.clang_getCursorUSR(self)
+
+        return self._usr
 
     def get_included_file(self):
         """Returns the File that is included by the current inclusion cursor."""
@@ -1842,6 +1965,90 @@ class Cursor(Structure):
             children)
         return iter(children)
 
+    # Values returned by the visit() callbacks, see CXChildVisitResult.
+    VISIT_BREAK = 0
+    VISIT_CONTINUE = 1
+    VISIT_RECURSE = 2
+
+    def visit(self, callback, prune=None):
+        """Depth-first preorder visit of the descendants of this cursor.
+
+        Unlike get_children(), the whole subtree is visited with a single
+        clang_visitChildren call and no Python recursion.
+
+        callback(cursor, parent, depth) is called for every descendant, depth
+        being 1 for the children of this cursor. It returns VISIT_RECURSE (or
+        None) to visit the children of the cursor, VISIT_CONTINUE to skip them
+        and VISIT_BREAK to stop the visit.
+
+        prune(cursor) is an optional predicate skipping a cursor along with its
+        descendants before the callback is called.
+
+        The data-recursive visit of libclang reports some expressions a second
+        time as children of themselves, and some implicit ones under a parent it
+        does not report. The duplicates are skipped and the missing parents are
+        resolved to a visited cursor, so the (cursor, depth) sequence is the
+        preorder of a get_children() walk.
+
+        Returns False if the visit was stopped by the callback.
+        """
+        # The parents of the visited cursors are tracked without calling back
+        # into libclang, see _visit_key().
+        parents = [_visit_key(self)]
+        nodes = [self]
+        error = []
+
+        def visitor(child, parent, data):
+            try:
+                key = _visit_key(parent)
+                if parents[-1] != key and key not in parents:
+                    # the parent of some implicit expressions is not reported,
+                    # e.g. for the captures of a lambda: it is resolved from the
+                    # extents of the visited cursors instead, a sibling such as
+                    # the VARIABLE_REF of a capture sharing the child extent
+                    extent = child.extent
+                    while len(parents) > 1 and not _encloses(nodes[-1].extent, extent):
+                        parents.pop()
+                        nodes.pop()
+                    key = parents[-1]
+                    parent = nodes[-1]
+                while parents[-1] != key:
+                    parents.pop()
+                    nodes.pop()
+                child_key = _visit_key(child)
+                if child_key == key:
+                    # a cursor reported again as a child of itself, its children
+                    # are reported under the duplicate and keep their depth
+                    return Cursor.VISIT_RECURSE
+                child._tu = self._tu
+                if prune is not None and prune(child):
+                    return Cursor.VISIT_CONTINUE
+                parent._tu = self._tu
+                r = callback(child, parent, len(parents))
+                if r is None or r == Cursor.VISIT_RECURSE:
+                    parents.append(child_key)
+                    nodes.append(child)
+                    return Cursor.VISIT_RECURSE
+                return r
+            except BaseException as e:
+                error.append(e)
+                return Cursor.VISIT_BREAK
+
+        r = conf.lib.clang_visitChildren(self, callbacks['cursor_visit'](visitor),
+            None)
+        if error:
+            raise error[0]
+        return r == 0
+
+    def snapshot(self):
+        """Return a CursorSnapshot of the commonly used properties of this
+        cursor.
+
+        The properties are fetched all at once and cached on the cursor, so
+        that the later accesses to them do not call into libclang again.
+        """
+        return CursorSnapshot(self)
+
     def walk_preorder(self):
         """Depth-first preorder walk over the cursor and its descendants.
 
@@ -1860,6 +2067,10 @@ class Cursor(Structure):
         """
         return TokenGroup.get_tokens(self._tu, self.extent)
 
+    def get_token_arrays(self):
+        """Obtain the tokens of this Cursor as a TokenArrays."""
+        return TokenArrays(self._tu, self.extent)
+
     def get_field_offsetof(self):
         """Returns the offsetof the FIELD_DECL pointed by this Cursor."""
         return conf.lib.clang_Cursor_getOffsetOfField(self)
@@ -1917,6 +2128,30 @@ class Cursor(Structure):
         res._tu = args[0]._tu
         return res
 
+class CursorSnapshot(object):
+    """
+    A lightweight record of the kind, USR, spelling, location, extent,
+    canonical, referenced and definition cursors of a cursor, see
+    Cursor.snapshot().
+    """
+    __slots__ = ('kind', 'usr', 'spelling', 'location', 'extent',
+                 'canonical', 'referenced', 'definition', 'is_definition')
+
+    def __init__(self, cursor):
+        self.kind = cursor.kind
+        self.usr = cursor.get_usr()
+        self.spelling = cursor.spelling
+        self.location = cursor.location
+        self.extent = cursor.extent
+        self.canonical = cursor.canonical
+        self.referenced = cursor.referenced
+        self.definition = cursor.get_definition()
+        self.is_definition = cursor.is_definition()
+
+    def __repr__(self):
+        return "<CursorSnapshot %s %r>" % (self.kind, self.spelling)
+
+
 class StorageClass(object):
     """
     Describes the storage class of a declaration
@@ -1985,6 +2220,40 @@ AvailabilityKind.DEPRECATED = AvailabilityKind(1)
 AvailabilityKind.NOT_AVAILABLE = AvailabilityKind(2)
 AvailabilityKind.NOT_ACCESSIBLE = AvailabilityKind(3)
 
+def _encloses(outer, inner):
+    """Whether the range outer strictly encloses the range inner."""
+    start, end = outer.start, outer.end
+    if start.file is None or inner.start.file is None:
+        return False
+    if start.file.name != inner.start.file.name:
+        return False
+    return (start.offset <= inner.start.offset and inner.end.offset <= end.offset
+            and outer != inner)
+
+def _visit_key(cursor, _kinds={}):
+    """Identity of a cursor in a visit, mirroring clang_equalCursors().
+
+    Statements and expressions are identified by their node only, as their
+    parent declaration may differ whether they are visited as a parent or as a
+    child. The "FirstInDeclGroup" part of the declarations is ignored.
+    """
+    k = cursor._kind_id
+    category = _kinds.get(k)
+    if category is None:
+        kind = cursor.kind
+        if kind.is_statement() or kind.is_expression():
+            category = 1
+        elif kind.is_declaration():
+            category = 2
+        else:
+            category = 0
+        _kinds[k] = category
+    if category == 1:
+        return (k, cursor.data[1])
+    if category == 2:
+        return (k, cursor.xdata, cursor.data[0], cursor.data[2])
+    return bytes(cursor)
+
 ### C++ access specifiers ###
 
 class AccessSpecifier(BaseEnumeration):
@@ -2924,6 +3193,20 @@ class TranslationUnit(ClangObject):
 
         return SourceLocation.from_position(self, f, position[0], position[1])
 
+    def get_skipped_ranges(self, file):
+        """Return the SourceRanges of the preprocessor regions skipped in the
+        given File, as the inactive #if blocks.
+
+        The translation unit must be parsed with the
+        PARSE_DETAILED_PROCESSING_RECORD option.
+        """
+        ranges = conf.lib.clang_getSkippedRanges(self, file)
+        try:
+            return [SourceRange.from_buffer_copy(ranges.contents.ranges[i])
+                    for i in range(ranges.contents.count)]
+        finally:
+            conf.lib.clang_disposeSourceRangeList(ranges)
+
     def get_extent(self, filename, locations):
         """Obtain a SourceRange from this translation unit.
 
@@ -3085,6 +3368,16 @@ class TranslationUnit(ClangObject):
 
         return TokenGroup.get_tokens(self, extent)
 
+    def get_token_arrays(self, locations=None, extent=None):
+        """Obtain the tokens in this translation unit as a TokenArrays.
+
+        The range of source code is specified as for get_tokens().
+        """
+        if locations is not None:
+            extent = SourceRange(start=locations[0], end=locations[1])
+
+        return TokenArrays(self, extent)
+
 class File(ClangObject):
     """
     The File class represents a particular source file that is part of a
@@ -3464,6 +3757,9 @@ functionList = [
   ("clang_disposeIndex",
    [Index]),
 
+  ("clang_disposeSourceRangeList",
+   [POINTER(_CXSourceRangeList)]),
+
   ("clang_disposeString",
    [_CXString]),
 
@@ -3714,6 +4010,10 @@ functionList = [
    [TranslationUnit, c_interop_string],
    c_object_p),
 
+  ("clang_getFileContents",
+   [TranslationUnit, File, POINTER(c_size_t)],
+   c_void_p),
+
   ("clang_getFileName",
    [File],
    _CXString,
@@ -3803,6 +4103,10 @@ functionList = [
    Type,
    Type.from_result),
 
+  ("clang_getSkippedRanges",
+   [TranslationUnit, File],
+   POINTER(_CXSourceRangeList)),
+
   ("clang_getSpecializedCursorTemplate",
    [Cursor],
    Cursor,
@@ -4202,6 +4506,7 @@ __all__ = [
     'CompileCommand',
     'CursorKind',
     'Cursor',
+    'CursorSnapshot',
     'Diagnostic',
     'File',
     'FixIt',
@@ -4210,9 +4515,11 @@ __all__ = [
     'SourceLocation',
     'SourceRange',
     'TLSKind',
+    'TokenArrays',
     'TokenKind',
     'Token',
     'TranslationUnitLoadError',
+    'TranslationUnitSaveError',
     'TranslationUnit',
     'TypeKind',
     'Type',
@@ -1,16 +1,25 @@
 #!/usr/bin/env python
 
-import os, sys, re, time, pprint, fnmatch
+import os, sys, re, time, array, ctypes, weakref, pprint, fnmatch, multiprocessing, multiprocessing.connection, threading, concurrent.futures, hashlib, pickle, bisect, functools, heapq, collections, itertools
 from clang.cindex import *
 from optparse import OptionParser, OptionGroup
 from pathlib import Path
 from enum import Enum
 
+try:
+	import numpy
+except ImportError:
+	numpy = None # required by --ast-tables, the DOI graph uses the array module without it
+
 default_discarded_cursor_kind_list = [ CursorKind.UNEXPOSED_DECL, CursorKind.UNEXPOSED_EXPR, CursorKind.NAMESPACE ]
+default_function_cursor_kind_list = [ CursorKind.FUNCTION_DECL, CursorKind.CXX_METHOD, CursorKind.CONSTRUCTOR, CursorKind.DESTRUCTOR, CursorKind.CONVERSION_FUNCTION, CursorKind.FUNCTION_TEMPLATE ]
 default_glob_patterns = ['*.c', '*.cpp']
 default_allow_list = [ "m c:@F@main" ]
 default_c_header_extensions = [ '.h', '.hpp', '.inl' ]
 default_clang_options = [ '-std=c++17' ] # see https://clang.llvm.org/docs/CommandGuide/clang.html
+default_schedule_include_cost = 0.05 # seconds per #include directive of a TU missing from the schedule history
+default_schedule_byte_cost = 1e-6 # seconds per byte of a TU without #include directive missing from the schedule history
+default_facts_version = 6 # bump when the TU facts layout changes to invalidate the facts caches
 
 
 
@@ -203,14 +212,18 @@ def diag_location_line(d):
 	else:
 		return None
 
-def node_location_file(n):
+def node_file(n):
 	# TU don't have location! Use extend instead.
-	if n.location and n.location.file:
-		return wpath('%s'%n.location.file)
-	elif n.extent and n.extent.start and n.extent.start.file:
-		return wpath('%s'%n.extent.start.file.name)
-	else:
-		return None
+	f = n.location.file if n.location else None
+	if f is None and n.extent and n.extent.start:
+		f = n.extent.start.file
+	if f is None or isinstance(f, FileFacts):
+		return f
+	return tu_file_table(n.translation_unit).get(f)
+
+def node_location_file(n):
+	f = node_file(n)
+	return f.path if f else None
 
 def node_location_line_range(n):
 	if n.extent and n.extent.start and n.extent.end:
@@ -243,13 +256,27 @@ def is_path_in_project(_wp):
 	return wp.startswith(g_opts.root)
 
 def is_node_in_project(node):
-	wp = node_location_file(node)
-	return wp is not None and is_path_in_project(wp)
+	f = node_file(node)
+	return f is not None and f.in_project
 
 def is_included_node(node):
-	n = node_location_file(node)
-	tu = node_location_file(node.translation_unit.cursor)
-	return n != tu
+	# files are interned per TU
+	return node_file(node) is not node_file(node.translation_unit.cursor)
+
+def node_shared_key(n):
+	# Identifies a declaration of an included file whatever the TU it was parsed from.
+	# Facts carry the key computed at extraction time.
+	if isinstance(n, CursorFacts):
+		return n.key
+	if not n.kind.is_declaration() or not is_node_in_project(n) or not is_included_node(n):
+		return None
+	return (node_location_file(n), n.extent.start.offset, n.extent.end.offset, n.kind.value, n.get_usr())
+
+def is_shared_node_in(n, nodes):
+	if n in nodes:
+		return True
+	key = node_shared_key(n) if g_opts.dedup_headers else None
+	return key is not None and any(node_shared_key(x) == key for x in nodes)
 
 def filter_included_nodes_duplication(nodes):
 	d = {}
@@ -259,20 +286,92 @@ def filter_included_nodes_duplication(nodes):
 	return list(d.values())
 
 
+def tu_number(tu, _numbers=weakref.WeakKeyDictionary(), _count=itertools.count()):
+	# facts carry the number of their TU, the parsed TUs are numbered in order of appearance
+	if isinstance(tu, TUFacts):
+		return tu.no
+	no = _numbers.get(tu)
+	if no is None:
+		no = _numbers[tu] = next(_count)
+	return no
+
+def node_key(n):
+	# clang_hashCursor() values are only unique within a TU, so they are prefixed with the TU number,
+	# as the facts hashes are.
+	if isinstance(n, CursorFacts):
+		return n.hash
+	return (tu_number(n.translation_unit) << 32) | n.hash
+
 def cursor_id(cursor, _map={}):
 	if cursor is None:
 		return -1
 	if not is_node_in_project(cursor):
 		return -1
-	return _map.setdefault(cursor.hash, len(_map))
+	return _map.setdefault(node_key(cursor), len(_map))
+
+# Nodes owned by the DOIs, by node key, and with --dedup-headers also by shared key:
+# the header duplicates pruned from the other TUs are resolved through it.
+doi_map = {}
+doi_shared_map = {}
 
-def cursor_doi(cursor, doi=None, _map={}):
+def cursor_doi(cursor):
 	if cursor is None:
 		return None
-	if doi:
-		return _map.setdefault(cursor.hash, doi)
-	else:
-		return _map.get(cursor.hash, None)
+	doi = doi_map.get(node_key(cursor), None)
+	if doi is None and g_opts.dedup_headers:
+		key = node_shared_key(cursor)
+		if key:
+			doi = doi_shared_map.get(key, None)
+	return doi
+
+class DeclarationScanner:
+	# Gathers what the DOI phases need from a top declaration subtree:
+	# the hashes of the nodes it owns, the shared keys of its header declarations and the targets of its references.
+
+	def __init__(self, node, target=lambda n: n):
+		self.hashes = []
+		self.keys = []
+		self.targets = []
+		self.target = target
+		self.shared = g_opts.dedup_headers and node_shared_key(node) is not None
+		self.add(node)
+
+	def add(self, n):
+		self.hashes.append(n.hash)
+		if self.shared and n.kind.is_declaration():
+			key = node_shared_key(n)
+			if key:
+				self.keys.append(key)
+		r = n.referenced
+		if r and r != n:
+			d = n.get_definition()
+			if d:
+				self.targets.append(self.target(d))
+			self.targets.append(self.target(r))
+
+	def scan(self):
+		return self.hashes, self.keys, self.targets
+
+def scan_declaration(node):
+	# single clang_visitChildren call for the whole subtree
+	scanner = DeclarationScanner(node)
+	node.visit(lambda c, parent, depth: scanner.add(c))
+	return scanner.scan()
+
+def declaration_scan(node, _map={}):
+	# The scans hold the hashes of the nodes within their TU, returned as node keys.
+	# Facts carry the scan made at extraction time.
+	if isinstance(node, CursorFacts):
+		hashes, keys, targets = node.scan
+		prefix = node.tu.no << 32
+		return [prefix | h for h in hashes], keys, [node._node(i) for i in targets]
+	key = node_key(node)
+	scan = _map.get(key)
+	if scan is None:
+		hashes, keys, targets = scan_declaration(node)
+		prefix = key & ~0xffffffff
+		scan = _map[key] = ([prefix | h for h in hashes], keys, targets)
+	return scan
 
 def cursor_doi_id(cursor):
 	if cursor is None:
@@ -287,28 +386,764 @@ def cursor_tu_id(cursor):
 
 
 
+# TU facts are compact and picklable copies of the few cursor properties the DOI phases rely on.
+# They mimic the subset of the Cursor API used by the collect/connect/unused phases,
+# so a TU could be parsed in a worker process while these phases run in the parent on the merged facts.
+# Facts hashes are prefixed with the TU number to not alias cursors of different TUs.
+
+class FileFacts:
+	__slots__ = ('name', 'id', 'path', 'in_project')
+
+	def __init__(self, name, id):
+		self.name = name
+		self.id = id
+		self.path = wpath(name)
+		self.in_project = is_path_in_project(self.path)
+
+	def __str__(self):
+		return self.name
+
+
+class FileTable:
+	# Interns the libclang files of a TU: each one gets a small id along with its normalized path and in-project flag,
+	# computed once instead of on every location check.
+
+	def __init__(self):
+		self.files = {}
+
+	def get(self, f):
+		key = ctypes.cast(f.obj, ctypes.c_void_p).value
+		ff = self.files.get(key)
+		if ff is None:
+			ff = self.files[key] = FileFacts(f.name, len(self.files))
+		return ff
+
+
+def tu_file_table(tu, _tables=weakref.WeakKeyDictionary()):
+	table = _tables.get(tu)
+	if table is None:
+		table = _tables[tu] = FileTable()
+	return table
+
+
+class LocationFacts:
+	__slots__ = ('file', 'line', 'column', 'offset')
+
+	def __init__(self, file, line, column, offset):
+		self.file = file
+		self.line = line
+		self.column = column
+		self.offset = offset
+
+
+class ExtentFacts:
+	__slots__ = ('start', 'end')
+
+	def __init__(self, start, end):
+		self.start = start
+		self.end = end
+
+
+class CursorFacts:
+	__slots__ = ('tu', '_hash', '_kind_id', 'usr', 'spelling', 'location', 'extent', '_is_def', 'children', '_canonical', '_referenced', '_definition', 'key', 'scan')
+
+	def __init__(self, tu, cursor):
+		self.tu = tu
+		self._hash = cursor.hash
+		self._kind_id = cursor._kind_id
+		self.usr = None
+		self.spelling = None
+		self.location = None
+		self.extent = None
+		self._is_def = False
+		self.children = ()
+		self._canonical = -1
+		self._referenced = -1
+		self._definition = -1
+		self.key = None
+		self.scan = None # see declaration_scan()
+
+	def __getstate__(self):
+		return (self.tu, self._hash, self._kind_id, self.usr, self.spelling, self.location, self.extent, self._is_def, self.children, self._canonical, self._referenced, self._definition, self.key, self.scan)
+
+	def __setstate__(self, state):
+		(self.tu, self._hash, self._kind_id, self.usr, self.spelling, self.location, self.extent, self._is_def, self.children, self._canonical, self._referenced, self._definition, self.key, self.scan) = state
+
+	def __eq__(self, other):
+		return other is not None and self.hash == other.hash
+
+	def __ne__(self, other):
+		return not self.__eq__(other)
+
+	def __hash__(self):
+		return self.hash
+
+	def _node(self, i):
+		return self.tu.nodes[i] if i >= 0 else None
+
+	@property
+	def hash(self):
+		return (self.tu.no << 32) | self._hash
+
+	@property
+	def kind(self):
+		return CursorKind.from_id(self._kind_id)
+
+	@property
+	def translation_unit(self):
+		return self.tu
+
+	@property
+	def canonical(self):
+		return self._node(self._canonical)
+
+	@property
+	def referenced(self):
+		return self._node(self._referenced)
+
+	def get_definition(self):
+		return self._node(self._definition)
+
+	def get_usr(self):
+		return self.usr
+
+	def is_definition(self):
+		return self._is_def
+
+	def get_children(self):
+		return iter([self.tu.nodes[i] for i in self.children])
+
+
+class TUFacts:
+
+	def __init__(self, path, no):
+		self.path = path
+		self.no = no
+		self.nodes = []
+		self.diags = [] # (severity, formatted message)
+		self.load_error = None
+		self.cached = False
+		self.parse_time = 0.0
+		self.walk_time = 0.0
+		self.failure = None # why a supervised TU was given up
+
+	@property
+	def cursor(self):
+		return self.nodes[0]
+
+
+def tu_diagnostics(tu):
+	return [(d.severity, str(d.format(Diagnostic._FormatOptionsMask))) for d in tu.diagnostics]
+
+
+@functools.lru_cache(maxsize=64)
+def source_text(path):
+	with open(path, 'rb') as fd:
+		source = fd.read()
+	line_starts = [0] + [m.end() for m in re.finditer(b'\n', source)]
+	return source, line_starts
+
+
+def directive_end(source, offset):
+	# a preprocessor directive runs to the end of its line, continued by a trailing backslash
+	j = source.find(b'\n', offset)
+	while j >= 0 and source[max(j-2, 0):j].rstrip(b'\r').endswith(b'\\'):
+		j = source.find(b'\n', j+1)
+	return len(source) if j < 0 else j
+
+
+def source_tokens(tu, f):
+	# The tokens of a file as lexed by libclang, without the preprocessor directives and the inactive regions
+	# (the TU must be parsed with PARSE_DETAILED_PROCESSING_RECORD): (offset, end offset, kind, text) tuples in source order.
+	source, line_starts = source_text(f.name)
+	extent = SourceRange.from_locations(SourceLocation.from_offset(tu, f, 0), SourceLocation.from_offset(tu, f, len(source)))
+	tokens = tu.get_token_arrays(extent=extent)
+	skipped = sorted((r.start.offset, r.end.offset) for r in tu.get_skipped_ranges(f))
+	significant = []
+	k = 0
+	end = 0
+	for offset,length,kind in zip(tokens.offsets, tokens.lengths, tokens.kinds):
+		while k < len(skipped) and skipped[k][1] <= offset:
+			k += 1
+		if offset < end or (k < len(skipped) and skipped[k][0] <= offset):
+			continue
+		text = source[offset:offset+length]
+		if text == b'#' and not source[source.rfind(b'\n', 0, offset)+1:offset].strip():
+			end = directive_end(source, offset)
+			continue
+		significant.append((offset, offset+length, kind, text))
+	return significant
+
+
+def macro_body_end(tu, f, offset):
+	# the end of the macro expansion at offset when its replacement holds braces, i.e. stands for a function body
+	c = Cursor.from_location(tu, SourceLocation.from_offset(tu, f, offset))
+	if c is None or c.kind != CursorKind.MACRO_INSTANTIATION:
+		return None
+	d = c.referenced
+	if d is None or not any(t.spelling == '{' for t in d.get_tokens()):
+		return None
+	return c.extent.end.offset
+
+
+def macro_declaration_end(tu, cursor):
+	# the last token of the macro replacement spelling the whole declaration, None when not spelled by a macro
+	start = cursor.extent.start
+	c = Cursor.from_location(tu, start)
+	if c is None or c.kind != CursorKind.MACRO_INSTANTIATION or c.extent.end.offset < cursor.extent.end.offset:
+		return None
+	d = c.referenced
+	tokens = list(d.get_tokens()) if d is not None else []
+	return tokens[-1].spelling if tokens else ''
+
+
+def skipped_body_end(tokens, i, limit, macro_body_end):
+	# With PARSE_SKIP_FUNCTION_BODIES, a function definition is reported as a mere declaration ending before its body.
+	# Scan the tokens following the declaration, from the i-th one up to the limit offset (the next sibling declaration),
+	# for a body through any constructor initializer list and return the offsets of its start and past its end.
+	# macro_body_end(offset) tells an identifier expanding to the body.
+	# None is returned for a declaration without body (including = default, = delete and pure virtual ones).
+	tokens = itertools.islice(tokens, i, None)
+	identifier = TokenKind.IDENTIFIER.value
+	none = (None, None, None, None)
+
+	def skip_group(open, close):
+		depth = 1
+		for offset,end,kind,text in tokens:
+			if text == open:
+				depth += 1
+			elif text == close:
+				depth -= 1
+				if depth == 0:
+					return end
+		return None
+
+	depth = 0
+	prev = none
+	init_list = False
+	for offset,end,kind,text in tokens:
+		if limit is not None and offset >= limit:
+			return None
+		if text in (b'(', b'['):
+			depth += 1
+		elif text in (b')', b']'):
+			depth -= 1
+		elif depth > 0:
+			pass
+		elif text in (b';', b'='):
+			return None
+		elif text == b':':
+			init_list = True
+		elif text == b'{' and init_list and (prev[2] == identifier or prev[3] == b'>'):
+			skip_group(b'{', b'}') # brace initialization of a member
+		elif text == b'{':
+			start = offset
+			end = skip_group(b'{', b'}')
+			# handlers of a function try block
+			while end is not None and next(tokens, none)[3] == b'catch':
+				end = None
+				if next(tokens, none)[3] == b'(' and skip_group(b'(', b')') is not None and next(tokens, none)[3] == b'{':
+					end = skip_group(b'{', b'}')
+			return (start, end) if end is not None else None
+		elif kind == identifier and not init_list:
+			end = macro_body_end(offset)
+			if end is not None:
+				return (offset, end)
+		prev = (offset, end, kind, text)
+	return None
+
+
+def extract_tu_facts(tu, facts):
+	# Records the in-project path nodes down to the top declarations as collect_top_declarations visits them,
+	# then the scan of each top declaration: the nodes it owns and the reference targets the connect phase resolves.
+	# Out-of-project subtrees never reach the DOI phases and are not recorded.
+	indices = {}
+	dedup = g_opts.dedup_headers
+
+	files = tu_file_table(tu)
+	file_tokens = {} # file name -> tokens and their offsets, see skipped_body_location()
+
+	def file_facts(f):
+		return files.get(f) if f is not None else None
+
+	def location_facts(loc):
+		return LocationFacts(file_facts(loc.file), loc.line, loc.column, loc.offset)
+
+	def owns_body(cursor, f, offset):
+		# the cursor found at the body is the declaration or one of its enclosing ones, not another declaration
+		c = Cursor.from_location(tu, SourceLocation.from_offset(tu, f, offset))
+		if c is None or not c.kind.is_declaration() or c == cursor:
+			return True
+		extent = c.extent
+		return extent.start.offset <= cursor.extent.start.offset and cursor.extent.end.offset <= extent.end.offset
+
+	def skipped_body_location(cursor, limit):
+		end = cursor.extent.end
+		f = end.file
+		if f is None:
+			return None
+		tokens = file_tokens.get(f.name)
+		if tokens is None:
+			try:
+				significant = source_tokens(tu, f)
+			except OSError:
+				return None
+			tokens = file_tokens[f.name] = (significant, [t[0] for t in significant])
+		significant, offsets = tokens
+		i = bisect.bisect_left(offsets, end.offset)
+		body = skipped_body_end(significant, i, limit, lambda o: macro_body_end(tu, f, o))
+		if body is None or not owns_body(cursor, f, body[0]):
+			return None
+		offset = body[1]
+		source, line_starts = source_text(f.name)
+		line = bisect.bisect_right(line_starts, offset-1)
+		return LocationFacts(file_facts(f), line, offset - line_starts[line-1] + 1, offset)
+
+	def resolve_skipped_body(n, cursor, limit):
+		tail = macro_declaration_end(tu, cursor)
+		if tail == '}':
+			n._is_def = True # the body is part of the expansion
+			return
+		if tail == ';':
+			return
+		end = skipped_body_location(cursor, limit)
+		if end:
+			n._is_def = True
+			n.extent.end = end
+
+	def resolve_pending(cursor, depth):
+		# The scan for a skipped body stops at the next sibling declaration in the same file,
+		# so a body is resolved once that sibling is visited, or at the end of the visit.
+		if cursor is None:
+			for n,c,d,f in pending:
+				resolve_skipped_body(n, c, None)
+			pending.clear()
+			return
+		start = cursor.extent.start
+		f = start.file.name if start.file else None
+		for p in list(pending):
+			n,c,d,pf = p
+			if depth <= d and f == pf and start.offset >= c.extent.end.offset:
+				resolve_skipped_body(n, c, start.offset)
+				pending.remove(p)
+
+	def add(cursor):
+		n = CursorFacts(facts, cursor)
+		i = len(facts.nodes)
+		facts.nodes.append(n)
+		indices.setdefault(n._hash, i)
+		return i
+
+	def ref(cursor):
+		if cursor is None:
+			return -1
+		i = indices.get(cursor.hash)
+		if i is None:
+			i = add(cursor)
+			if dedup:
+				facts.nodes[i].key = node_shared_key(cursor)
+		return i
+
+	def add_references(n, cursor):
+		r = cursor.referenced
+		if r and r != cursor:
+			n._referenced = ref(r)
+			n._definition = ref(cursor.get_definition())
+
+	def is_extracted(cursor):
+		# header subtrees already extracted from a previous TU of this process
+		if g_thread.extracted_keys is None:
+			return False
+		key = node_shared_key(cursor)
+		if key is None:
+			return False
+		if key in g_thread.extracted_keys:
+			return True
+		g_thread.extracted_keys.add(key)
+		return False
+
+	def add_path(cursor):
+		# returns the scanner of a top declaration
+		i = add(cursor)
+		n = facts.nodes[i]
+		n.children = []
+		path.append(n)
+		if dedup:
+			n.key = node_shared_key(cursor)
+		s = cursor.snapshot()
+		n.usr = s.usr
+		n.spelling = s.spelling
+		n.location = location_facts(s.location)
+		n.extent = ExtentFacts(location_facts(s.extent.start), location_facts(s.extent.end))
+		if s.kind.is_declaration() and n.usr and s.kind not in default_discarded_cursor_kind_list:
+			n._is_def = s.is_definition
+			if not n._is_def and g_parse_options & TranslationUnit.PARSE_SKIP_FUNCTION_BODIES and s.kind in default_function_cursor_kind_list:
+				f = s.extent.end.file
+				pending.append( (n, cursor, len(path)-1, f.name if f else None) )
+			n._canonical = ref(s.canonical)
+			add_references(n, cursor)
+			return DeclarationScanner(cursor, target=ref)
+		return None
+
+	def end_scan():
+		hashes, keys, targets = scanner.scan()
+		path[-1].scan = (tuple(hashes), tuple(keys), tuple(targets))
+
+	def visitor(cursor, parent, depth):
+		# The whole TU is visited with a single clang_visitChildren call:
+		# the nodes deeper than a top declaration feed its scanner, the others are path nodes.
+		nonlocal scanner
+		if scanner:
+			if depth > len(path) - 1:
+				scanner.add(cursor)
+				return Cursor.VISIT_RECURSE
+			end_scan()
+			scanner = None
+		if pending and not cursor.kind.is_preprocessing():
+			resolve_pending(cursor, depth)
+		if cursor.kind.is_preprocessing() or not is_node_in_project(cursor) or is_extracted(cursor):
+			# the preprocessing cursors are only there for the skipped function bodies, see get_parse_options()
+			return Cursor.VISIT_CONTINUE
+		del path[depth:]
+		path[-1].children.append(len(facts.nodes))
+		scanner = add_path(cursor)
+		return Cursor.VISIT_RECURSE
+
+	path = [] # path nodes from the root to the visited cursor
+	scanner = None
+	pending = [] # (node, cursor, depth, file name) of the declarations with a skipped body to resolve
+	root = tu.cursor
+	if is_node_in_project(root):
+		add_path(root)
+		root.visit(visitor)
+		if scanner:
+			end_scan()
+		resolve_pending(None, 0)
+		for n in facts.nodes:
+			n.children = tuple(n.children)
+	else:
+		i = add(root)
+		facts.nodes[i].extent = ExtentFacts(location_facts(root.extent.start), location_facts(root.extent.end))
+	return facts
+
+
+# AST tables flatten a TU into parallel arrays, one entry per node in preorder, saved as a .npz file per TU.
+# Strings are interned into the 'files' and 'usrs' arrays, and -1 stands for none in the id and index arrays.
+
+def build_ast_table(tu):
+	parent = []
+	kind = []
+	file = []
+	start_line = []
+	end_line = []
+	start_offset = []
+	end_offset = []
+	usr = []
+	referenced = [] # hashes first, then indices
+	is_def = []
+	indices = {}
+	files = tu_file_table(tu)
+	usrs = {}
+	stack = []
+
+	def add(c, p):
+		indices.setdefault(c.hash, len(parent))
+		parent.append(p)
+		kind.append(c._kind_id)
+		extent = c.extent
+		start = extent.start
+		end = extent.end
+		file.append(files.get(start.file).id if start.file else -1)
+		start_line.append(start.line)
+		end_line.append(end.line)
+		start_offset.append(start.offset)
+		end_offset.append(end.offset)
+		u = c.get_usr()
+		usr.append(usrs.setdefault(u, len(usrs)) if u else -1)
+		r = c.referenced
+		referenced.append(r.hash if r else None)
+		is_def.append(c.is_definition())
+
+	def visitor(c, p, depth):
+		# the visit skips the cursors libclang reports again as children of themselves
+		del stack[depth:]
+		stack.append(len(parent))
+		add(c, stack[-2])
+
+	root = tu.cursor
+	stack.append(0)
+	add(root, -1)
+	root.visit(visitor, prune=None if g_opts.full_ast else lambda c: not is_node_in_project(c))
+
+	return {
+		'parent': numpy.array(parent, dtype=numpy.int32),
+		'kind_id': numpy.array(kind, dtype=numpy.int16),
+		'file_id': numpy.array(file, dtype=numpy.int32),
+		'start_line': numpy.array(start_line, dtype=numpy.int32),
+		'end_line': numpy.array(end_line, dtype=numpy.int32),
+		'start_offset': numpy.array(start_offset, dtype=numpy.int32),
+		'end_offset': numpy.array(end_offset, dtype=numpy.int32),
+		'usr_id': numpy.array(usr, dtype=numpy.int32),
+		'referenced': numpy.array([indices.get(h, -1) if h is not None else -1 for h in referenced], dtype=numpy.int32),
+		'is_def': numpy.array(is_def, dtype=numpy.bool_),
+		'files': numpy.array([ff.path for ff in files.files.values()], dtype=numpy.str_),
+		'usrs': numpy.array(list(usrs), dtype=numpy.str_),
+	}
+
+def ast_table_path(f):
+	return os.path.join(g_opts.ast_tables, os.path.relpath(f, g_opts.root) + '.npz')
+
+def save_ast_table(f, tu):
+	path = ast_table_path(f)
+	os.makedirs(os.path.dirname(path), exist_ok=True)
+	numpy.savez_compressed(path, **build_ast_table(tu))
+
+def load_ast_table(path):
+	with numpy.load(path) as table:
+		return {k: table[k] for k in table.files}
+
+
+def file_digest(path, _memo={}):
+	# content digests are memoized per process until the file stat changes
+	try:
+		st = os.stat(path)
+	except OSError:
+		return None
+	stamp = (st.st_mtime_ns, st.st_size)
+	m = _memo.get(path)
+	if m is None or m[0] != stamp:
+		with open(path, 'rb') as fd:
+			m = _memo[path] = (stamp, hashlib.sha1(fd.read()).hexdigest())
+	return m[1]
+
+
+def tu_dependencies(tu):
+	deps = [tu.spelling]
+	for i in tu.get_includes():
+		name = '%s'%i.include
+		if name not in deps:
+			deps.append(name)
+	return deps
+
+
+class TUCache:
+	# Content addressed cache of per-TU artifacts.
+	# A manifest keyed by the TU inputs (path, clang args) lists the files the TU depends on, as reported by get_includes().
+	# The artifacts are stored under a content key hashing these inputs along with the content of every dependency.
+
+	def __init__(self, root, tag):
+		self.root = root
+		self.tag = tag
+		os.makedirs(root, exist_ok=True)
+
+	def _path(self, key, ext):
+		return os.path.join(self.root, key[:2], key + ext)
+
+	def _inputs(self, f, args):
+		return (self.tag, f, args)
+
+	def _inputs_key(self, f, args):
+		return hashlib.sha1(repr(self._inputs(f, args)).encode()).hexdigest()
+
+	def _content_key(self, inputs_key, deps):
+		h = hashlib.sha1(inputs_key.encode())
+		for d in deps:
+			digest = file_digest(d)
+			if digest is None:
+				return None
+			h.update(f"{d}\0{digest}\0".encode())
+		return h.hexdigest()
+
+	def _read(self, path):
+		try:
+			with open(path, 'rb') as fd:
+				return pickle.load(fd)
+		except (OSError, EOFError, pickle.UnpicklingError):
+			return None
+
+	def _write(self, path, obj):
+		os.makedirs(os.path.dirname(path), exist_ok=True)
+		tmp = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+		with open(tmp, 'wb') as fd:
+			pickle.dump(obj, fd, protocol=pickle.HIGHEST_PROTOCOL)
+		os.replace(tmp, path)
+
+	def _save(self, tu, path):
+		os.makedirs(os.path.dirname(path), exist_ok=True)
+		tmp = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+		try:
+			tu.save(tmp)
+		except TranslationUnitSaveError:
+			return False
+		os.replace(tmp, path)
+		return True
+
+	def lookup(self, f, args):
+		inputs_key = self._inputs_key(f, args)
+		deps = self._read(self._path(inputs_key, '.deps'))
+		if deps is None:
+			return None, None
+		return self._content_key(inputs_key, deps), deps
+
+	def register(self, f, args, deps):
+		inputs_key = self._inputs_key(f, args)
+		content_key = self._content_key(inputs_key, deps)
+		if content_key is not None:
+			self._write(self._path(inputs_key, '.deps'), deps)
+		return content_key
+
+
+class FactsCache(TUCache):
+
+	def __init__(self, root):
+		TUCache.__init__(self, root, 'facts')
+
+	def _inputs(self, f, args):
+		# the root folder drives which subtrees are extracted
+		return (self.tag, default_facts_version, g_opts.root, g_opts.dedup_headers, g_parse_options, f, args)
+
+	def load(self, f, args):
+		key, deps = self.lookup(f, args)
+		return self._read(self._path(key, '.facts')) if key else None
+
+	def store(self, f, args, deps, facts):
+		key = self.register(f, args, deps)
+		if key:
+			self._write(self._path(key, '.facts'), facts)
+
+
+class AstCache(TUCache):
+	# TUs are serialized with TranslationUnit.save() and reloaded through Index.read().
+	# A loaded AST neither reports its diagnostics nor its inclusions, they are kept aside.
+	# libclang rebuilds some implicit nodes of a loaded AST, e.g. the default member initializers, on every walk:
+	# their hashes, hence their node keys, differ from one walk to the next and can not be looked up afterwards.
+
+	def __init__(self, root):
+		TUCache.__init__(self, root, 'ast')
+
+	def _inputs(self, f, args):
+		return (self.tag, g_parse_options, f, args)
+
+	def load(self, index, f, args):
+		key, deps = self.lookup(f, args)
+		if not key:
+			return None
+		diags = self._read(self._path(key, '.diags'))
+		if diags is None:
+			return None
+		try:
+			tu = index.read(self._path(key, '.ast'))
+		except TranslationUnitLoadError:
+			return None
+		return tu, diags, deps
+
+	def store(self, f, args, deps, tu, diags):
+		key = self.register(f, args, deps)
+		if key and self._save(tu, self._path(key, '.ast')):
+			self._write(self._path(key, '.diags'), diags)
+
+
+class PchCache(TUCache):
+	# Precompiled headers are built by saving the TU of the header itself.
+	# Their path embeds the content key so the args of the TUs including them change along with the header content,
+	# which keeps the facts and AST caches consistent.
+
+	def __init__(self, root):
+		TUCache.__init__(self, root, 'pch')
+
+	def build(self, index, header, args):
+		key, deps = self.lookup(header, args)
+		if key and os.path.exists(self._path(key, '.pch')):
+			return self._path(key, '.pch')
+		try:
+			tu = index.parse(header, args + ['-x', 'c++-header'], options=TranslationUnit.PARSE_INCOMPLETE)
+		except TranslationUnitLoadError:
+			return None
+		diags = tu_diagnostics(tu)
+		if any(severity >= Diagnostic.Error for severity,text in diags):
+			return None
+		key = self.register(header, args, tu_dependencies(tu))
+		if key and self._save(tu, self._path(key, '.pch')):
+			return self._path(key, '.pch')
+		return None
+
+
+# A shard file is a pickle stream made of a header, the facts of the shard TUs in the input order and a None end marker.
+# Facts keep the TU numbers of the whole input list, so the shards merge back in the order of a single run.
+
+class ShardWriter:
+
+	def __init__(self, path, shard, count):
+		self.path = path
+		self.tmp = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+		self.fd = open(self.tmp, 'wb')
+		self._dump({ 'version': default_facts_version, 'root': g_opts.root, 'shard': shard, 'count': count,
+			'decls_only': g_opts.decls_only, 'dedup_headers': g_opts.dedup_headers })
+
+	def _dump(self, obj):
+		pickle.dump(obj, self.fd, protocol=pickle.HIGHEST_PROTOCOL)
+
+	def write(self, facts):
+		self._dump(facts)
+
+	def close(self):
+		self._dump(None)
+		self.fd.close()
+		os.replace(self.tmp, self.path)
+
+
+def read_shard_header(path):
+	with open(path, 'rb') as fd:
+		return pickle.load(fd)
+
+def read_shard(path):
+	with open(path, 'rb') as fd:
+		pickle.load(fd)
+		while True:
+			try:
+				facts = pickle.load(fd)
+			except (EOFError, pickle.UnpicklingError):
+				print( f"Truncated shard file \"{path}\"" )
+				print( "Fatal merging error. Aborted." )
+				exit(1)
+			if facts is None:
+				break
+			yield facts
+
+def merge_shards(paths):
+	# every shard is ordered by TU number
+	return heapq.merge(*[read_shard(p) for p in paths], key=lambda facts: facts.no)
+
+
+
 class DefinitionOfInterest:
-	def __init__(self, node):
+	def __init__(self, node, allow_usr, index):
 		self.node = node
+		self.index = index # in the DOI graph, see DoiGraph
 		self.id = cursor_id(node)
-		self.usr = node.get_usr()
-		self.allow_usr = get_allow_usr(node) # special usr for segmentation purpose (see allow lists)
+		self.usr = usr_pool.id(node.get_usr()) # USR ids, see usr_pool
+		self.allow_usr = allow_usr # special usr for segmentation purpose (see allow lists)
 		self.allowance = get_node_allowance(node) # see UsrAllowance
 		self.tu = node.translation_unit
 		self.externals = [] # external declarations (forwards, type alias, ...) and definitions (methods, ...)
-		self.in_refs = set() # DOIs referencing this DOI
-		self.out_refs = set() # DOIs referenced by this DOI
-		self.tag_rec(node)
 
-	def tag_rec(self, n):
-		cursor_doi(n, self)
-		for c in n.get_children():
-			self.tag_rec(c)
+	def tag(self, n):
+		# returns the node keys and shared keys newly owned by this DOI
+		owned = []
+		hashes, keys, targets = declaration_scan(n)
+		for h in hashes:
+			if doi_map.setdefault(h, self) is self:
+				owned.append(h)
+		for k in keys:
+			if doi_shared_map.setdefault(k, self) is self:
+				owned.append(k)
+		return owned
 
 	def attach_external(self, n):
 		if n != self.node:
 			self.externals.append(n)
-			self.tag_rec(n)
+			return self.tag(n)
+		return []
 
 
 
@@ -319,10 +1154,62 @@ class UsrAllowance(Enum):
 	Mutant = 4
 
 
+class AllowListMatcher:
+	# Aho-Corasick automaton of the allow list patterns: a USR is scanned once whatever the number of patterns.
+	# Every state holds the best allowance among the patterns ending there, M > L > D as ranked below.
+
+	ranks = [UsrAllowance.Mutant, UsrAllowance.Living, UsrAllowance.Dead, UsrAllowance.Zombi]
+
+	def __init__(self, patterns):
+		none = len(self.ranks) - 1
+		self.goto = [{}]
+		self.fail = [0]
+		self.best = [none]
+		for rank,pattern in patterns:
+			s = 0
+			for ch in pattern:
+				t = self.goto[s].get(ch)
+				if t is None:
+					t = self.goto[s][ch] = len(self.goto)
+					self.goto.append({})
+					self.fail.append(0)
+					self.best.append(none)
+				s = t
+			self.best[s] = min(self.best[s], rank)
+		# breadth first, the fail state of a state being shallower
+		queue = collections.deque(self.goto[0].values())
+		while queue:
+			s = queue.popleft()
+			self.best[s] = min(self.best[s], self.best[self.fail[s]])
+			for ch,t in self.goto[s].items():
+				f = self.fail[s]
+				while f and ch not in self.goto[f]:
+					f = self.fail[f]
+				self.fail[t] = self.goto[f].get(ch, 0) if s else 0
+				queue.append(t)
+
+	def match(self, usr):
+		goto = self.goto
+		fail = self.fail
+		best = self.best
+		b = best[0]
+		s = 0
+		for ch in usr:
+			if b == 0:
+				break
+			while s and ch not in goto[s]:
+				s = fail[s]
+			s = goto[s].get(ch, 0)
+			if best[s] < b:
+				b = best[s]
+		return self.ranks[b]
+
+
 def init_allow_list(allow_list):
 	global allow_Llist
 	global allow_Dlist
 	global allow_Mlist
+	global allow_matcher
 
 	allow_Llist = []
 	allow_Dlist = []
@@ -336,135 +1223,264 @@ def init_allow_list(allow_list):
 		elif l.startswith('m'):
 			allow_Mlist.append( l[1:].strip() )
 
+	allow_matcher = AllowListMatcher([(0, m) for m in allow_Mlist] + [(1, l) for l in allow_Llist] + [(2, d) for d in allow_Dlist])
+
 
 def get_usr_allowance(usr):
 	if not usr:
 		return None
-	for m in allow_Mlist:
-		if m in usr:
-			return UsrAllowance.Mutant
-	for l in allow_Llist:
-		if l in usr:
-			return UsrAllowance.Living
-	for d in allow_Dlist:
-		if d in usr:
-			return UsrAllowance.Dead
-	return UsrAllowance.Zombi
+	return allow_matcher.match(usr)
+
+
+class UsrPool:
+	# Dense integer ids of the USRs: each distinct USR string is stored once
+	# and its allowance is matched once against the allow lists.
+
+	def __init__(self):
+		self.ids = {}
+		self.usrs = []
+		self.allowances = []
+
+	def id(self, usr):
+		if not usr:
+			return None
+		i = self.ids.get(usr)
+		if i is None:
+			i = self.ids[usr] = len(self.usrs)
+			self.usrs.append(usr)
+			self.allowances.append(None)
+		return i
+
+	def __getitem__(self, i):
+		return self.usrs[i]
+
+	def __len__(self):
+		return len(self.usrs)
+
+	def intern(self, usr):
+		i = self.id(usr)
+		return usr if i is None else self.usrs[i]
+
+	def allowance(self, i):
+		a = self.allowances[i]
+		if a is None:
+			a = self.allowances[i] = get_usr_allowance(self.usrs[i])
+		return a
+
+usr_pool = UsrPool()
+
+
+def intern_facts_usrs(facts):
+	# share the USR strings unpickled for every TU with the pool
+	for n in facts.nodes:
+		n.usr = usr_pool.intern(n.usr)
 
 
 def get_node_allowance(node):
-	usr = node.get_usr()
-	return get_usr_allowance(usr)
+	i = usr_pool.id(node.get_usr())
+	return None if i is None else usr_pool.allowance(i)
 
 
-def get_allow_usr(node):
-	usr = node.get_usr()
-	alw = get_usr_allowance(usr)
-	if alw == UsrAllowance.Mutant:
+def get_allow_usr_id(node):
+	i = usr_pool.id(node.get_usr())
+	if i is not None and usr_pool.allowance(i) == UsrAllowance.Mutant:
 		# prefix 'mutant' node with tu path id to be unique!
 		# this is typically required to dissociate the different main functions for instance.
 		assert not is_included_node(node)
 		tu_id = cursor_tu_id(node)
-		return "tu%d-%s" % (tu_id, usr)
-	else:
-		return usr
+		return usr_pool.id("tu%d-%s" % (tu_id, usr_pool[i]))
+	return i
 
 
-def collect_top_declarations(top_decls, node):
+def get_allow_usr(node):
+	i = get_allow_usr_id(node)
+	return node.get_usr() if i is None else usr_pool[i]
+
+
+def collect_top_declarations(top_decls, node, shared=None):
 	if is_node_in_project(node):
-		usr = get_allow_usr(node)
-		if node.kind.is_declaration() and usr and node.kind not in default_discarded_cursor_kind_list:
+		if shared is not None:
+			# prune the header subtrees already collected from a previous TU
+			key = node_shared_key(node)
+			if key:
+				if key in shared:
+					return
+				shared.add(key)
+		usr = get_allow_usr_id(node)
+		if node.kind.is_declaration() and usr is not None and node.kind not in default_discarded_cursor_kind_list:
 			if usr in top_decls:
 				top_decls[usr].append(node)
 			else:
 				top_decls[usr] = [node]
 		else:
 			for c in node.get_children():
-				collect_top_declarations(top_decls, c)
+				collect_top_declarations(top_decls, c, shared)
 
 
 def dois_collect(dois, top_decls, orphan_decls):
-
-	def tag_rec(node, doi):
-		cursor_doi(node, doi)
-		for c in node.get_children():
-			tag_rec(c, doi)
-
-	def collect_pass(in_top_decls):
-		pending_decls = {}
-
-		for usr,decls in in_top_decls.items():
-			doi = None
-
+	# The DOIs are created from the clean top-level definitions, and the other USR groups are assigned
+	# to the DOI owning the canonical node of one of their declarations.
+	# A group waiting for such a DOI is indexed by the keys of its canonical nodes, and only examined again
+	# once one of these keys gets owned: the groups are resolved in the order repeated passes over
+	# the pending groups would, without rescanning them.
+
+	groups = list(top_decls.items())
+	pending = set() # indices of the groups without DOI
+	waiting = {} # canonical node key -> indices of the pending groups
+	current = [] # heaps of the indices of the pending groups to examine in this pass and the next one
+	upcoming = []
+	position = -1
+
+	def wake(keys):
+		for k in keys:
+			for j in waiting.pop(k, ()):
+				heapq.heappush(current if j > position else upcoming, j)
+
+	def wait(i, decls):
+		pending.add(i)
+		for d in decls:
+			c = d.canonical
+			if c is None:
+				continue
+			waiting.setdefault(node_key(c), []).append(i)
+			key = node_shared_key(c) if g_opts.dedup_headers else None
+			if key:
+				waiting.setdefault(key, []).append(i)
+
+	def examine(i, first):
+		usr, decls = groups[i]
+		doi = None
+
+		if first:
 			# Find first definition among same USR decls.
 			# Same identical definitions included from .h files in different TUs are disconnected (no canonical links).
 			# They are duplicated but share the same USRs.
 			# I noted some USRs from included definitions could have a '#' postfix for some obscure reasons to me atm (example: c:@F@simpleProcess1 instead of c:@F@simpleProcess1#)
 			defs = [d for d in decls if d.is_definition()]
 
-			if not defs or (defs[0].canonical not in decls):
-				# top level decls have no definitions?
-				# or the definition is non canonical (i.e. a non top level declaration exists!)
-				# try to find an associated DOI
-				for d in decls:
-					doi = cursor_doi(d.canonical) if not doi else doi
-				if doi is None:
-					# wait for another round maybe?
-					pending_decls[usr] = decls
-			else:
+			if defs and is_shared_node_in(defs[0].canonical, decls):
 				# create a new DOI from this clean top-level definition
-				doi = dois.setdefault(usr, DefinitionOfInterest(defs[0]))
-
-			# assigned to the leading DOI
-			if doi:
-				for d in decls:
-					doi.attach_external(d)
-
-			if g_opts.trace and g_opts.trace in usr:
-				for d in decls:
-					dbg_node_info(d)
+				doi = dois[usr] = DefinitionOfInterest(defs[0], usr, len(dois))
+				wake(doi.tag(doi.node))
+
+		if doi is None:
+			# top level decls have no definitions?
+			# or the definition is non canonical (i.e. a non top level declaration exists!)
+			# try to find an associated DOI
+			for d in decls:
+				doi = cursor_doi(d.canonical)
+				if doi:
+					break
+			if doi is None:
+				if first:
+					wait(i, decls)
+			else:
+				pending.discard(i)
+
+		# assigned to the leading DOI
+		if doi:
+			for d in decls:
+				wake(doi.attach_external(d))
+
+		if g_opts.trace and g_opts.trace in usr_pool[usr]:
+			for d in decls:
+				dbg_node_info(d)
+
+	for position in range(len(groups)):
+		examine(position, True)
+
+	while upcoming:
+		current, upcoming = upcoming, []
+		heapq.heapify(current)
+		position = -1
+		while current:
+			position = heapq.heappop(current)
+			if position in pending:
+				examine(position, False)
+
+	for i in sorted(pending):
+		usr, decls = groups[i]
+		orphan_decls[usr] = decls
+
+
+def csr_arrays(count, sources, targets):
+	# compressed sparse rows of the deduplicated edges: the targets of the row i are targets[offsets[i]:offsets[i+1]], sorted
+	n = max(count, 1)
+	if numpy is not None:
+		keys = numpy.unique(numpy.asarray(sources, dtype=numpy.int64) * n + numpy.asarray(targets, dtype=numpy.int64))
+		offsets = numpy.zeros(count + 1, dtype=numpy.int32)
+		numpy.cumsum(numpy.bincount(keys // n, minlength=count), out=offsets[1:])
+		return offsets, (keys % n).astype(numpy.int32)
+	keys = sorted(set(s * n + t for s,t in zip(sources, targets)))
+	offsets = array.array('i', [0]) * (count + 1)
+	for k in keys:
+		offsets[k // n + 1] += 1
+	for i in range(count):
+		offsets[i + 1] += offsets[i]
+	return offsets, array.array('i', [k % n for k in keys])
+
+
+class DoiGraph:
+	# References between the DOIs, by DOI index, as CSR int32 arrays (NumPy ones when available):
+	# the DOIs referencing a DOI are found in the transpose of the graph of the DOIs it references.
+
+	def __init__(self, count, sources, targets):
+		self.count = count
+		self.out_offsets, self.out_targets = csr_arrays(count, sources, targets)
+		self.in_offsets, self.in_targets = self.transpose()
+
+	def transpose(self):
+		if numpy is not None:
+			sources = numpy.repeat(numpy.arange(self.count, dtype=numpy.int32), numpy.diff(self.out_offsets))
+		else:
+			sources = array.array('i')
+			for i in range(self.count):
+				sources.extend([i] * (self.out_offsets[i+1] - self.out_offsets[i]))
+		return csr_arrays(self.count, self.out_targets, sources)
 
-		return pending_decls
+	def out_refs(self, i):
+		# indices of the DOIs referenced by the DOI i
+		return self.out_targets[self.out_offsets[i]:self.out_offsets[i+1]]
 
-	# we do multiple passes to give a chance to non-canonical decl to be associated
-	# to an existing DOI created
+	def in_refs(self, i):
+		# indices of the DOIs referencing the DOI i
+		return self.in_targets[self.in_offsets[i]:self.in_offsets[i+1]]
 
-	pending_decls = top_decls
+	def out_count(self, i):
+		return int(self.out_offsets[i+1] - self.out_offsets[i])
 
-	while pending_decls:
-		pending_cnt = len(pending_decls)
-		pending_decls = collect_pass( pending_decls )
-		if len(pending_decls) == pending_cnt:
-			break
-
-	orphan_decls.update(pending_decls)
+	def in_count(self, i):
+		return int(self.in_offsets[i+1] - self.in_offsets[i])
 
 
 def dois_connect(dois):
+	# returns the DoiGraph of the references
+	sources = array.array('i')
+	targets = array.array('i')
 
 	def connect(doi, target_node):
 		target_doi = cursor_doi(target_node)
 		if target_doi and target_doi != doi:
-			doi.out_refs.add(target_doi)
-			target_doi.in_refs.add(doi)
+			sources.append(doi.index)
+			targets.append(target_doi.index)
 
-	def connect_rec(doi, node):
-		if node.referenced and node.referenced!=node:
-			connect(doi, node.get_definition())
-			connect(doi, node.referenced)
-		for c in node.get_children():
-			connect_rec(doi, c)
+	def connect_scan(doi, node):
+		hashes, keys, targets = declaration_scan(node)
+		for t in targets:
+			connect(doi, t)
 
 	if g_opts.verbose > 0:
 		print( "Connecting ..." )
 
 	for usr,doi in dois.items():
-		connect_rec(doi, doi.node)
+		connect_scan(doi, doi.node)
 		for x in doi.externals:
-			connect_rec(doi, x)
+			connect_scan(doi, x)
+
+	return DoiGraph(len(dois), sources, targets)
 
 
-def dois_track_unused(dois, output):
+def dois_track_unused(dois, graph, output):
 
 	livings = []
 	deads = []
@@ -476,7 +1492,7 @@ def dois_track_unused(dois, output):
 	for usr,doi in dois.items():
 		if doi.allowance == UsrAllowance.Living or doi.allowance == UsrAllowance.Mutant:
 			livings.append( doi )
-		elif doi.allowance == UsrAllowance.Dead or len(doi.in_refs)==0:
+		elif doi.allowance == UsrAllowance.Dead or graph.in_count(doi.index)==0:
 			deads.append( doi )
 		else:
 			zombies.append( doi )
@@ -492,20 +1508,23 @@ def dois_track_unused(dois, output):
 	if g_opts.verbose > 0:
 		print( "Segmentation in progress ..." )
 
-	cured = [] + livings
-
-	while len(cured) > 0:
-		_cured = cured
-		cured = []
-		for doi in _cured:
-			for out_doi in doi.out_refs:
-				try:
-					i = zombies.index( out_doi )
-					del zombies[i]
-					cured.append( out_doi )
-					livings.append( out_doi )
-				except ValueError:
-					pass
+	# breadth first propagation from the livings, curing the zombies they reach
+
+	indexed_dois = list(dois.values())
+	zombie = bytearray(len(indexed_dois))
+	for doi in zombies:
+		zombie[doi.index] = 1
+
+	cured = collections.deque(doi.index for doi in livings)
+
+	while cured:
+		for j in graph.out_refs(cured.popleft()):
+			if zombie[j]:
+				zombie[j] = 0
+				cured.append(j)
+				livings.append(indexed_dois[j])
+
+	zombies = [doi for doi in zombies if zombie[doi.index]]
 
 	# zombies become deads only if livings had failed
 	# at least it needs one living doi
@@ -534,22 +1553,75 @@ def dois_track_unused(dois, output):
 	output.write( f"\n{dead_line_counter} lines were found unused.\n" )
 
 
+def dois_track_roots(dois, graph, output):
+	# Every living or mutant DOI is a root with its own bit (main() functions of the projects by default).
+	# The bitsets of the roots reaching the DOIs are propagated through the graph in a single worklist pass,
+	# a DOI being visited again only when its bitset grows. As for the liveness, dead DOIs are not cured.
+
+	indexed_dois = list(dois.values())
+	roots = [doi for doi in indexed_dois if doi.allowance == UsrAllowance.Living or doi.allowance == UsrAllowance.Mutant]
+	reached = [0] * len(indexed_dois)
+	queued = bytearray(len(indexed_dois))
+	queue = collections.deque()
+
+	if g_opts.verbose > 0:
+		print( f"Tracking {len(roots)} roots ..." )
+
+	for r,doi in enumerate(roots):
+		reached[doi.index] |= 1 << r
+		queued[doi.index] = 1
+		queue.append(doi.index)
+
+	while queue:
+		i = queue.popleft()
+		queued[i] = 0
+		bits = reached[i]
+		for j in graph.out_refs(i):
+			if bits & ~reached[j] and indexed_dois[j].allowance != UsrAllowance.Dead:
+				reached[j] |= bits
+				if not queued[j]:
+					queued[j] = 1
+					queue.append(j)
+
+	for r,doi in enumerate(roots):
+		output.write( f"ROOT {r}: doi-usr {usr_pool[doi.allow_usr]}: {fmt_oneline_node(doi.node)}\n" )
+	output.write( "\n" )
+
+	only = [[] for r in roots] # DOIs kept alive by a single root
+	for usr,doi in dois.items():
+		bits = reached[doi.index]
+		if not bits:
+			continue
+		root_ids = [r for r in range(bits.bit_length()) if bits >> r & 1]
+		output.write( f"DOI: doi-usr {usr_pool[usr]}: roots {root_ids}: {fmt_oneline_node(doi.node)}\n" )
+		if len(root_ids) == 1 and doi is not roots[root_ids[0]]:
+			only[root_ids[0]].append(doi)
+
+	for r,dois_only in enumerate(only):
+		nodes = [filter_included_nodes_duplication( [doi.node] + doi.externals ) for doi in dois_only]
+		lines_cnt = sum( node_location_line_count(n) for doi_nodes in nodes for n in doi_nodes )
+		output.write( f"\nROOT {r}: {len(dois_only)} DOIs, {lines_cnt} lines only kept alive by it\n" )
+		for doi_nodes in nodes:
+			for n in doi_nodes:
+				output.write( f"{r}| {fmt_oneline_node(n)}\n" )
+
+
 def fmt_oneline_node(node):
 	cursor_id(node)
 	usr = node.get_usr()
 	c_id = cursor_id(node)
 	tu_id = cursor_tu_id(node)
 	k = str(node.kind).split('.')[1]
-	a = str(get_usr_allowance(usr)).split('.')[1]
+	a = str(get_node_allowance(node)).split('.')[1]
 	locf = node_location_file(node)
 	loclines = node_location_line_range(node)
 	return f"id {c_id}: tu {tu_id}: alw {a}: usr {usr}: loc {locf}{loclines}: kind {k}: {node.spelling}"
 
 
-def fmt_node(node, children=None):
+def fmt_node(node, children=None, doi=None):
 	cursor_id(node)
 	return { 'id' : cursor_id(node),
-			 'doi-id' : cursor_doi_id(node),
+			 'doi-id' : cursor_id(doi.node) if doi else cursor_doi_id(node),
 			 'kind' : f"{str(node.kind).split('.')[1]} {{{node_kind_mask(node)}}}",
 			 'usr' : node.get_usr(),
 			 'allow-usr' : get_allow_usr(node),
@@ -563,15 +1635,402 @@ def fmt_node(node, children=None):
 			 'children' : children }
 
 
-def fmt_node_rec(node, filtering_off=False, depth=0):
+def fmt_node_rec(node, filtering_off=False, depth=0, doi=None):
+	# a DOI owns its whole subtree: the nodes not found by their key, see AstCache, get the DOI of their ancestors
 	if not node.kind.is_unexposed():
 		cursor_id(node)
+		doi = cursor_doi(node) or doi
 		children = []
 		if (g_opts.ast_max_depth <= 0) or (depth < g_opts.ast_max_depth):
 			for c in node.get_children():
 				if filtering_off or is_node_in_project(c):
-					children.append( fmt_node_rec(c, filtering_off, depth+1) )
-		return fmt_node(node, children)
+					children.append( fmt_node_rec(c, filtering_off, depth+1, doi) )
+		return fmt_node(node, children, doi)
+
+
+def get_tu_base_clang_args(ftu, clang_args):
+	tu_clang_args = [i for i in clang_args]
+	for hdir in ftu.additional_directories:
+		tu_clang_args += ['-I', hdir]
+	return tu_clang_args
+
+
+def get_tu_clang_args(ftu, clang_args, pchs={}):
+	tu_clang_args = get_tu_base_clang_args(ftu, clang_args)
+	if ftu.precompile_header:
+		pch = pchs.get( (ftu.precompile_header, tuple(tu_clang_args)) )
+		if pch:
+			tu_clang_args += ['-include-pch', pch]
+		else:
+			tu_clang_args += ['-include', ftu.precompile_header]
+	return tu_clang_args
+
+
+def build_pchs(files, clang_args):
+	# One PCH is built for each distinct pair of precompiled header and args, typically one per project.
+	# TUs whose PCH could not be built fall back to a plain inclusion of the header.
+	cache = PchCache(g_opts.pch_dir)
+	index = Index.create()
+	pchs = {}
+	for f,ftu in files.items():
+		if ftu.precompile_header:
+			args = get_tu_base_clang_args(ftu, clang_args)
+			k = (ftu.precompile_header, tuple(args))
+			if k not in pchs:
+				print( f"@@ Precompiling \"{ftu.precompile_header}\" ...")
+				pchs[k] = cache.build(index, ftu.precompile_header, args)
+				if not pchs[k]:
+					print( f"Unable to precompile \"{ftu.precompile_header}\", it is included instead." )
+	return pchs
+
+
+def fatal_diagnostic(diags):
+	for severity,text in diags:
+		if severity==Diagnostic.Fatal:
+			return text
+	return None
+
+def check_tu_diagnostics(diags, errors):
+	# see https://clang.llvm.org/docs/DiagnosticsReference.html
+	for severity,text in diags:
+		if severity==Diagnostic.Fatal:
+			print( text )
+			print( "Fatal parsing error. Aborted." )
+			exit(1)
+
+		if g_opts.show_diags:
+			if severity > Diagnostic.Warning:
+				errors.append(text)
+			if severity > Diagnostic.Warning or g_opts.show_warnings:
+				print( text )
+
+	if len(diags) > 0 and g_opts.stop_on_diags:
+		print(f"({len(diags)}) diags found so far... Stopped.")
+		exit(1)
+
+
+def get_parse_options(opts):
+	# function bodies only matter to the references between DOIs,
+	# the preprocessing record allows to recover the extent of the skipped ones, see skipped_body_end()
+	if opts.decls_only:
+		return TranslationUnit.PARSE_SKIP_FUNCTION_BODIES | TranslationUnit.PARSE_DETAILED_PROCESSING_RECORD
+	return TranslationUnit.PARSE_NONE
+
+
+g_thread = threading.local()
+
+def init_parsing_thread():
+	# Each parsing thread owns its libclang index and the header keys it has extracted.
+	g_thread.index = Index.create()
+	# Pruning at extraction depends on the TUs extracted before by this thread: it is only done when all of them are
+	# extracted in the input order by this one, otherwise the collect phase prunes the facts in the input order.
+	# Cached facts must not depend on the TUs extracted before them either.
+	serial = g_opts.jobs <= 1 and g_opts.threads <= 1 and not is_supervised(g_opts)
+	g_thread.extracted_keys = set() if g_opts.dedup_headers and serial and not g_opts.facts_cache else None
+
+
+def init_parsing(opts):
+	global g_opts
+	global g_parse_options
+	global g_facts_cache
+	global g_ast_cache
+	g_opts = opts
+	g_parse_options = get_parse_options(opts)
+	g_facts_cache = FactsCache(opts.facts_cache) if opts.facts_cache else None
+	g_ast_cache = AstCache(opts.ast_cache) if opts.ast_cache else None
+	# also loads the libclang functions of the conf singleton before any parsing thread starts
+	init_parsing_thread()
+
+
+def load_tu(f, tu_clang_args):
+	# The AST cache is a cheaper tier than parsing the TU again.
+	r = g_ast_cache.load(g_thread.index, f, tu_clang_args) if g_ast_cache else None
+	if not r:
+		tu = g_thread.index.parse(f, tu_clang_args, options=g_parse_options)
+		diags = tu_diagnostics(tu)
+		deps = tu_dependencies(tu) if g_ast_cache or g_facts_cache else None
+		if g_ast_cache:
+			g_ast_cache.store(f, tu_clang_args, deps, tu, diags)
+		r = (tu, diags, deps)
+	if g_opts.ast_tables:
+		save_ast_table(f, r[0])
+	return r
+
+
+def facts_worker(work):
+	no, f, tu_clang_args = work
+	if g_facts_cache:
+		facts = g_facts_cache.load(f, tu_clang_args)
+		if facts:
+			facts.no = no
+			facts.cached = True
+			return facts
+	facts = TUFacts(f, no)
+	start_tm = time.time()
+	try:
+		tu, facts.diags, deps = load_tu(f, tu_clang_args)
+	except TranslationUnitLoadError:
+		facts.load_error = f"cindex.TranslationUnitLoadError received while parsing input \"{f}\""
+		return facts
+	facts.parse_time = time.time() - start_tm
+	extract_tu_facts(tu, facts)
+	facts.walk_time = time.time() - start_tm - facts.parse_time
+	if g_facts_cache:
+		g_facts_cache.store(f, tu_clang_args, deps, facts)
+	return facts
+
+
+def load_schedule_history(path):
+	# one "parse-time walk-time path" line per TU
+	history = {}
+	try:
+		with open(path, 'r') as fd:
+			for l in fd:
+				v = l.rstrip('\n').split('\t')
+				if len(v) == 3:
+					history[v[2]] = (float(v[0]), float(v[1]))
+	except (OSError, ValueError):
+		pass
+	return history
+
+
+def save_schedule_history(path, history):
+	tmp = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+	with open(tmp, 'w') as fd:
+		for f,(parse_tm, walk_tm) in sorted(history.items()):
+			fd.write( f"{parse_tm:.3f}\t{walk_tm:.3f}\t{f}\n" )
+	os.replace(tmp, path)
+
+
+def source_size_hints(path, _include_re=re.compile(rb'^[ \t]*#[ \t]*include\b', re.M)):
+	try:
+		with open(path, 'rb') as fd:
+			source = fd.read()
+	except OSError:
+		return 0, 0
+	return len(_include_re.findall(source)), len(source)
+
+
+def estimate_tu_costs(files, history):
+	# The recorded parse and walk time of a TU is its cost.
+	# Unknown TUs are estimated from their #include count, or their size, at the average rates of the known TUs.
+	hints = {f: source_size_hints(f) for f in files}
+	known = [f for f in files if f in history]
+	include_cost = default_schedule_include_cost
+	byte_cost = default_schedule_byte_cost
+	if known:
+		known_tm = sum(sum(history[f]) for f in known)
+		known_includes = sum(hints[f][0] for f in known)
+		known_size = sum(hints[f][1] for f in known)
+		if known_includes:
+			include_cost = known_tm / known_includes
+		if known_size:
+			byte_cost = known_tm / known_size
+	costs = {}
+	for f in files:
+		if f in history:
+			costs[f] = sum(history[f])
+		else:
+			includes, size = hints[f]
+			costs[f] = includes * include_cost if includes else size * byte_cost
+	return costs
+
+
+def schedule_makespan(costs, jobs):
+	# greedy assignment of the ordered costs to the least loaded worker, as the pool does
+	loads = [0.0] * jobs
+	for c in costs:
+		heapq.heappush(loads, heapq.heappop(loads) + c)
+	return max(loads)
+
+
+def pool_tus_facts(work):
+	with multiprocessing.Pool(g_opts.jobs, initializer=init_parsing, initargs=(g_opts,)) as pool:
+		yield from pool.imap(facts_worker, work)
+
+
+def thread_tus_facts(work):
+	# ctypes releases the GIL during the libclang calls, the threads overlap the parsing of their TUs.
+	# The DOI phases and their cursor maps are only run by the main thread on the yielded facts.
+	with concurrent.futures.ThreadPoolExecutor(g_opts.threads, initializer=init_parsing_thread) as executor:
+		yield from executor.map(facts_worker, work)
+
+
+def supervised_worker(conn, opts):
+	init_parsing(opts)
+	while True:
+		try:
+			work = conn.recv()
+		except EOFError:
+			break
+		if work is None:
+			break
+		try:
+			facts = facts_worker(work)
+		except Exception as e:
+			no, f, tu_clang_args = work
+			facts = TUFacts(f, no)
+			facts.load_error = f"{type(e).__name__} received while parsing input \"{f}\": {e}"
+		conn.send(facts)
+
+
+class SupervisedWorker:
+
+	def __init__(self):
+		self.conn, conn = multiprocessing.Pipe()
+		self.process = multiprocessing.Process(target=supervised_worker, args=(conn, g_opts), daemon=True)
+		self.process.start()
+		conn.close()
+		self.work = None
+		self.start_tm = None
+
+	def send(self, work):
+		self.work = work
+		self.start_tm = time.time()
+		self.conn.send(work)
+
+	def stop(self):
+		try:
+			self.conn.send(None)
+		except OSError:
+			pass
+		self.process.join()
+
+	def kill(self):
+		self.process.kill()
+		self.process.join()
+		self.conn.close()
+
+
+def is_supervised(opts):
+	return opts.tu_timeout > 0 or opts.failure_report
+
+def supervise_tus_facts(work):
+	# Each TU is parsed by a worker process which is killed when it outlives the --tu-timeout.
+	# A TU whose worker crashed, timed out or failed to parse it is retried once, then given up:
+	# it is yielded with a failure to let the run complete with a partial coverage.
+	# A TU with a fatal diagnostic is given up at once instead of aborting the whole run.
+	queue = collections.deque(work)
+	attempts = {}
+	failures = []
+	workers = [SupervisedWorker() for i in range(min(max(g_opts.jobs, 1), len(work)))]
+	busy = []
+
+	def give_up(w, failure, retry=True):
+		no, f, tu_clang_args = w
+		attempts[no] = attempts.get(no, 0) + 1
+		if retry and attempts[no] < 2:
+			print( f"@@ Retrying \"{f}\" ({failure})" )
+			queue.append(w)
+			return None
+		facts = TUFacts(f, no)
+		facts.failure = failure
+		failures.append( (f, failure) )
+		return facts
+
+	try:
+		while queue or busy:
+			while queue and workers:
+				worker = workers.pop()
+				worker.send(queue.popleft())
+				busy.append(worker)
+
+			timeout = None
+			if g_opts.tu_timeout > 0:
+				timeout = max(0, min(w.start_tm + g_opts.tu_timeout for w in busy) - time.time())
+			multiprocessing.connection.wait([w.conn for w in busy] + [w.process.sentinel for w in busy], timeout)
+
+			for worker in list(busy):
+				facts = None
+				failure = None
+				if worker.conn.poll():
+					try:
+						facts = worker.conn.recv()
+					except (EOFError, OSError):
+						failure = f"crashed with exit code {worker.process.exitcode}"
+				elif not worker.process.is_alive():
+					failure = f"crashed with exit code {worker.process.exitcode}"
+				elif g_opts.tu_timeout > 0 and time.time() - worker.start_tm > g_opts.tu_timeout:
+					failure = f"timed out after {g_opts.tu_timeout}s"
+				else:
+					continue
+
+				busy.remove(worker)
+				w = worker.work
+				if failure:
+					worker.kill()
+					worker = SupervisedWorker()
+				elif facts.load_error:
+					failure = facts.load_error
+				elif fatal_diagnostic(facts.diags):
+					failure = fatal_diagnostic(facts.diags)
+				workers.append(worker)
+				if failure:
+					facts = give_up(w, failure, not facts or not fatal_diagnostic(facts.diags))
+				if facts:
+					yield facts
+	finally:
+		# the report is written as well when the run is stopped on the way
+		for worker in busy:
+			worker.kill()
+		for worker in workers:
+			worker.stop()
+
+		if g_opts.failure_report:
+			with open(g_opts.failure_report, "w") as output:
+				for f,failure in failures:
+					output.write( f"{f}: {failure}\n" )
+
+
+def parse_tus_facts(files, clang_args, pchs):
+	# With more than one job, TUs are parsed by a pool of worker processes, each owning its own index.
+	# The workers are supervised instead with a --tu-timeout or a --failure-report.
+	# With more than one thread, TUs are parsed by a pool of threads of this process.
+	# With a schedule history, the longest TUs are dispatched first so the pool does not end on them.
+	# Facts are yielded in the input order to keep the collect phase deterministic.
+	work = [(no, f, get_tu_clang_args(ftu, clang_args, pchs)) for no,(f,ftu) in enumerate(files.items())]
+	if g_opts.shard:
+		i, n = g_opts.shard
+		work = [w for w in work if w[0] % n == i - 1]
+	history = load_schedule_history(g_opts.schedule_file) if g_opts.schedule_file else None
+	if g_opts.jobs > 1 or g_opts.threads > 1 or is_supervised(g_opts):
+		if g_opts.threads > 1:
+			init_parsing(g_opts)
+		if history is not None:
+			work_files = [w[1] for w in work]
+			costs = estimate_tu_costs(work_files, history)
+			work.sort(key=lambda w: costs[w[1]], reverse=True)
+			if g_opts.verbose > 0:
+				total = sum(costs.values())
+				workers = max(g_opts.jobs, g_opts.threads)
+				makespan = schedule_makespan([costs[w[1]] for w in work], workers)
+				print( f"schedule: {len([f for f in work_files if f in history])}/{len(work_files)} known TUs, expected makespan {round(makespan,1)}s for {round(total,1)}s of work over {workers} workers (ideal {round(total/workers,1)}s)" )
+		pending = {}
+		order = sorted(w[0] for w in work)
+		next_i = 0
+		if is_supervised(g_opts):
+			results = supervise_tus_facts(work)
+		elif g_opts.threads > 1:
+			results = thread_tus_facts(work)
+		else:
+			results = pool_tus_facts(work)
+		for facts in results:
+			pending[facts.no] = facts
+			while next_i < len(order) and order[next_i] in pending:
+				facts = pending.pop(order[next_i])
+				next_i += 1
+				if history is not None and not facts.cached and not facts.failure:
+					history[facts.path] = (facts.parse_time, facts.walk_time)
+				yield facts
+	else:
+		init_parsing(g_opts)
+		for w in work:
+			facts = facts_worker(w)
+			if history is not None and not facts.cached:
+				history[facts.path] = (facts.parse_time, facts.walk_time)
+			yield facts
+	if history is not None:
+		save_schedule_history(g_opts.schedule_file, history)
 
 
 def main():
@@ -601,6 +2060,10 @@ def main():
 		for f in glob_from_dir(r, patterns):
 			l[f] = Parsing_TU(f)
 
+	def paths_opt(opt, opt_str, value, parser):
+		l = getattr(parser.values, opt.dest)
+		l.extend( [wpath(os.path.abspath(p)) for p in value.split()] )
+
 	def tu_opt(opt, opt_str, value, parser):
 		l = getattr(parser.values, opt.dest)
 		l.extend( [p for p in value.split()] )
@@ -675,6 +2138,10 @@ def main():
 					  help="Output unused section of code into the given file.",
 					  type="string", action="callback", callback=path_opt, default=None)
 
+	parser.add_option("", "--roots-output", dest="roots_file",
+					  help="Output which living and mutant DOIs (the main() functions by default) keep each DOI alive into the given file.",
+					  type="string", action="callback", callback=path_opt, default=None)
+
 	parser.add_option("", "--allow", dest="allow_file",
 					  help="Provide a file containing a white and black lists of code USRs used to seed analyzing processing.",
 					  type="string", action="callback", callback=path_opt, default=None)
@@ -692,13 +2159,73 @@ def main():
 					  type="string", action="callback", callback=tu_opt, default=[])
 
 	parser.add_option("", "--full-ast", dest="full_ast",
-					  help="Output the full AST w/o any filtering.",
+					  help="Output the full AST (and the AST tables) w/o any filtering.",
 					  action="store_true", default=False)
 
+	parser.add_option("", "--ast-tables", dest="ast_tables",
+					  help="Output the AST of each parsed TU as columnar NumPy arrays into a .npz file of the given folder. Requires numpy, not compatible with --facts-cache and --merge.",
+					  type="string", action="callback", callback=path_opt, default=None)
+
 	parser.add_option("-t", "--trace", dest="trace",
 					  help="Trace a USR.",
 					  type="string", default=None)
 
+	parser.add_option("", "--stream", dest="stream",
+					  help="Extract the facts of each TU right after its parsing and dispose it, so the memory does not grow with the amount of parsed TUs.",
+					  action="store_true", default=False)
+
+	parser.add_option("-j", "--jobs", dest="jobs",
+					  help="Parse the TUs with the given number of worker processes.",
+					  type="int", action="store", default=1)
+
+	parser.add_option("", "--threads", dest="threads",
+					  help="Parse the TUs with the given number of threads of a single process, each owning its own index.",
+					  type="int", action="store", default=1)
+
+	parser.add_option("", "--facts-cache", dest="facts_cache",
+					  help="Cache the per-TU facts into the given folder. TUs whose inputs and included files are unchanged are not parsed again.",
+					  type="string", action="callback", callback=path_opt, default=None)
+
+	parser.add_option("", "--ast-cache", dest="ast_cache",
+					  help="Cache the parsed TUs as serialized AST files into the given folder. TUs whose inputs and included files are unchanged are reloaded instead of parsed.",
+					  type="string", action="callback", callback=path_opt, default=None)
+
+	parser.add_option("", "--pch", dest="pch_dir",
+					  help="Build the precompiled header of each project once into the given folder and use it instead of including the header in every TU.",
+					  type="string", action="callback", callback=path_opt, default=None)
+
+	parser.add_option("", "--decls-only", dest="decls_only",
+					  help="Skip the parsing of function bodies to only output the DOIs of --decl, without their references. Can not be combined with --ref, --unused, --unused-output nor --roots-output.",
+					  action="store_true", default=False)
+
+	parser.add_option("", "--dedup-headers", dest="dedup_headers",
+					  help="Walk the declarations of an included file only for the first TU including it. They are identified by their file, extent offsets, kind and USR.",
+					  action="store_true", default=False)
+
+	parser.add_option("", "--schedule-history", dest="schedule_file",
+					  help="Record the parse and walk times of the TUs into the given file, and dispatch the longest TUs first to the --jobs workers.",
+					  type="string", action="callback", callback=path_opt, default=None)
+
+	parser.add_option("", "--shard", dest="shard",
+					  help="Only parse the i-th of N deterministic subsets of the TUs (1 <= i <= N) and write their facts to the --shard-output file. Example: --shard 2/8",
+					  type="string", default=None)
+
+	parser.add_option("", "--shard-output", dest="shard_file",
+					  help="Output the facts of the --shard TUs to the given file.",
+					  type="string", action="callback", callback=path_opt, default=None)
+
+	parser.add_option("", "--merge", dest="merge_files",
+					  help="Run the analysis on the union of the given shard files instead of parsing source files. This option could be used more than one time.",
+					  type="string", action="callback", callback=paths_opt, default=[])
+
+	parser.add_option("", "--tu-timeout", dest="tu_timeout",
+					  help="Parse each TU in a supervised worker process killed after the given number of seconds. A TU whose worker crashed, timed out or failed to parse it is retried once, then skipped.",
+					  type="float", action="store", default=0)
+
+	parser.add_option("", "--failure-report", dest="failure_report",
+					  help="Parse the TUs in supervised worker processes and output the TUs given up to the given file.",
+					  type="string", action="callback", callback=path_opt, default=None)
+
 	parser.add_option("-c", "--clang", dest="clang_args",
 					  help="Pass arbitrary arguments to clang processing. See https://clang.llvm.org/docs/CommandGuide/clang.html",
 					  action="callback", callback=clang_opt, default=[])
@@ -725,9 +2252,53 @@ def main():
 			if not is_path_in_project(f):
 				del g_opts.files[f]
 
-	if not g_opts.files:
+	if g_opts.merge_files:
+		if g_opts.files:
+			parser.error("Do not combine --merge with source file(s).")
+		headers = [read_shard_header(f) for f in g_opts.merge_files]
+		if any(h['version'] != default_facts_version for h in headers):
+			parser.error("The shard files were written by another version of the tool.")
+		if any(h['root'] != g_opts.root for h in headers):
+			parser.error("The shard files were written for another root folder.")
+		n = headers[0]['shard'][1]
+		if sorted(h['shard'] for h in headers) != [(i, n) for i in range(1, n+1)] or len(set(h['count'] for h in headers)) != 1:
+			parser.error("The shard files do not make up a complete set of shards.")
+		if headers[0]['decls_only'] and (g_opts.ref_file or g_opts.unused or g_opts.unused_file or g_opts.roots_file):
+			parser.error("The shard files were written with --decls-only and can not provide --ref, --unused, --unused-output nor --roots-output.")
+		g_opts.decls_only = g_opts.decls_only or headers[0]['decls_only']
+		g_opts.dedup_headers = headers[0]['dedup_headers']
+	elif not g_opts.files:
 		parser.error("No source file(s)! Use --help to see options.")
 
+	if g_opts.shard:
+		m = re.match(r'^(\d+)/(\d+)$', g_opts.shard)
+		if not m or not 1 <= int(m[1]) <= int(m[2]):
+			parser.error("The --shard option expects i/N with 1 <= i <= N.")
+		if not g_opts.shard_file:
+			parser.error("The --shard option requires a --shard-output file.")
+		if g_opts.merge_files:
+			parser.error("Do not combine --shard with --merge.")
+		g_opts.shard = (int(m[1]), int(m[2]))
+
+	if g_opts.decls_only and (g_opts.ref_file or g_opts.unused or g_opts.unused_file or g_opts.roots_file):
+		# the references made from the skipped function bodies would be missing
+		parser.error("Do not combine --decls-only with --ref, --unused, --unused-output or --roots-output.")
+
+	if g_opts.ast_tables and numpy is None:
+		parser.error("The --ast-tables option requires numpy.")
+
+	if g_opts.ast_tables and (g_opts.facts_cache or g_opts.merge_files):
+		# the TUs found in the facts cache or in the shard files are not parsed
+		parser.error("Do not combine --ast-tables with --facts-cache or --merge.")
+
+	if g_opts.threads > 1 and (g_opts.jobs > 1 or is_supervised(g_opts)):
+		parser.error("Do not combine --threads with --jobs, --tu-timeout or --failure-report.")
+
+	use_facts = g_opts.stream or g_opts.jobs > 1 or g_opts.threads > 1 or g_opts.facts_cache or g_opts.decls_only or g_opts.schedule_file or g_opts.shard or g_opts.merge_files or is_supervised(g_opts)
+
+	if g_opts.ast_file and use_facts:
+		parser.error("The AST output requires the TUs to be parsed in process. Do not combine --ast with --stream, --jobs, --threads, --facts-cache, --decls-only, --schedule-history, --shard, --merge, --tu-timeout or --failure-report.")
+
 	if g_opts.no_headers:
 		input_files = g_opts.files
 		g_opts.files = {}
@@ -751,10 +2322,25 @@ def main():
 		print( f"ast-file: {g_opts.ast_file}" )
 		print( f"ast-max-depth: {g_opts.ast_max_depth}" )
 		print( f"ast-tus: {g_opts.ast_tus}" )
+		print( f"ast-tables: {g_opts.ast_tables}" )
 		print( f"ref-file: {g_opts.ref_file}" )
 		print( f"decl-file: {g_opts.decl_file}" )
 		print( f"unused-file: {g_opts.unused_file}" )
 		print( f"clang-args: {clang_args}" )
+		print( f"stream: {g_opts.stream}" )
+		print( f"jobs: {g_opts.jobs}" )
+		print( f"threads: {g_opts.threads}" )
+		print( f"facts-cache: {g_opts.facts_cache}" )
+		print( f"ast-cache: {g_opts.ast_cache}" )
+		print( f"pch: {g_opts.pch_dir}" )
+		print( f"decls-only: {g_opts.decls_only}" )
+		print( f"dedup-headers: {g_opts.dedup_headers}" )
+		print( f"schedule-history: {g_opts.schedule_file}" )
+		print( f"shard: {g_opts.shard}" )
+		print( f"shard-output: {g_opts.shard_file}" )
+		print( f"merge: {g_opts.merge_files}" )
+		print( f"tu-timeout: {g_opts.tu_timeout}" )
+		print( f"failure-report: {g_opts.failure_report}" )
 		print( f"input-files ({len(g_opts.files)}):" )
 		for f in g_opts.files:
 			print( f"\t\"{f}\"" )
@@ -765,56 +2351,74 @@ def main():
 	orphan_decls = {}
 	errors = []
 	dois = {}
+	cached = 0
+	failed = 0
+	shared = set() if g_opts.dedup_headers else None
 
 	start_tm = time.time()
 
-	index = Index.create()
-
-	for f,ftu in g_opts.files.items():
-		print( f"@@ Parsing \"{f}\" ...")
+	pchs = build_pchs(g_opts.files, clang_args) if g_opts.pch_dir else {}
 
-		try:
-			tu_clang_args = [i for i in clang_args]
-			for hdir in ftu.additional_directories:
-				tu_clang_args += ['-I', hdir]
-			if ftu.precompile_header:
-				tu_clang_args += ['-include', ftu.precompile_header]
-			if g_opts.verbose > 1:
-				print( f"@@ Args {tu_clang_args}")
-			tu = index.parse(f, tu_clang_args)
-		except TranslationUnitLoadError:
-			print( f"cindex.TranslationUnitLoadError received while parsing input \"{f}\"" )
-			print( "Fatal parsing error. Aborted." )
-			exit(1)
-
-		if not tu:
-			print( f"Unable to load input \"{f}\"" )
-			print( "Fatal parsing error. Aborted." )
-			exit(1)
-
-		# check diags
-		# see https://clang.llvm.org/docs/DiagnosticsReference.html
-		for d in tu.diagnostics:
-			def print_diag_info(diag):
-				print( f"{str(diag.format(Diagnostic._FormatOptionsMask))}")
-
-			if d.severity==Diagnostic.Fatal:
-				print_diag_info(d)
+	if use_facts:
+		if g_opts.merge_files:
+			all_facts = merge_shards(g_opts.merge_files)
+		else:
+			all_facts = parse_tus_facts(g_opts.files, clang_args, pchs)
+		shard_output = ShardWriter(g_opts.shard_file, g_opts.shard, len(g_opts.files)) if g_opts.shard else None
+
+		for facts in all_facts:
+			print( f"@@ Parsing \"{facts.path}\" ...")
+			if g_opts.verbose > 1 and facts.path in g_opts.files:
+				print( f"@@ Args {get_tu_clang_args(g_opts.files[facts.path], clang_args, pchs)}")
+			if facts.failure:
+				print( f"@@ Given up \"{facts.path}\": {facts.failure}" )
+				failed += 1
+			elif facts.load_error:
+				print( facts.load_error )
+				print( "Fatal parsing error. Aborted." )
+				exit(1)
+			check_tu_diagnostics(facts.diags, errors)
+			cached += facts.cached
+			if shard_output:
+				shard_output.write(facts)
+			elif not facts.failure:
+				intern_facts_usrs(facts)
+				collect_top_declarations(top_decls, facts.cursor, shared)
+
+		if failed:
+			print( f"{failed} TU(s) were given up, the analysis only covers the other ones." )
+
+		if shard_output:
+			shard_output.close()
+			end_tm = time.time()
+			print( f"Shard {g_opts.shard[0]}/{g_opts.shard[1]} written to \"{g_opts.shard_file}\" in {round(end_tm-start_tm,1)}s" )
+			return
+	else:
+		init_parsing(g_opts)
+
+		for f,ftu in g_opts.files.items():
+			print( f"@@ Parsing \"{f}\" ...")
+
+			try:
+				tu_clang_args = get_tu_clang_args(ftu, clang_args, pchs)
+				if g_opts.verbose > 1:
+					print( f"@@ Args {tu_clang_args}")
+				tu, diags, deps = load_tu(f, tu_clang_args)
+			except TranslationUnitLoadError:
+				print( f"cindex.TranslationUnitLoadError received while parsing input \"{f}\"" )
 				print( "Fatal parsing error. Aborted." )
 				exit(1)
 
-			if g_opts.show_diags:
-				if d.severity > Diagnostic.Warning:
-					errors.append(d)
-				if d.severity > Diagnostic.Warning or g_opts.show_warnings:
-					print_diag_info(d)
+			if not tu:
+				print( f"Unable to load input \"{f}\"" )
+				print( "Fatal parsing error. Aborted." )
+				exit(1)
 
-		if len(tu.diagnostics) > 0 and g_opts.stop_on_diags:
-			print(f"({len(tu.diagnostics)}) diags found so far... Stopped.")
-			exit(1)
+			check_tu_diagnostics(diags, errors)
 
-		tus[f] = tu
-		collect_top_declarations(top_decls, tu.cursor)
+			if g_opts.ast_file:
+				tus[f] = tu
+			collect_top_declarations(top_decls, tu.cursor, shared)
 
 
 	if len(top_decls) == 0:
@@ -823,6 +2427,8 @@ def main():
 
 	if g_opts.verbose > 0:
 		print( f"#top-decls: {len(top_decls)}")
+		if g_opts.facts_cache:
+			print( f"#facts-cache-hits: {cached}/{len(g_opts.files)}")
 
 	dois_collect(dois, top_decls, orphan_decls)
 
@@ -831,7 +2437,8 @@ def main():
 		print( f"#dois: {len(dois)}")
 		print( f"#orphans: {len(orphan_decls)}")
 
-	dois_connect(dois)
+	if not g_opts.decls_only:
+		graph = dois_connect(dois)
 
 	if g_opts.ast_file:
 		pp_ast = pprint.PrettyPrinter(indent=4, width=99, compact=False, sort_dicts=False, stream=open(g_opts.ast_file,"w"))
@@ -842,21 +2449,30 @@ def main():
 	if g_opts.decl_file:
 		with open(g_opts.decl_file, "w") as output:
 			for usr,doi in dois.items():
-				output.write( f"DOI: doi-usr {usr}: {fmt_oneline_node(doi.node)}: in/out {len(doi.in_refs)}/{len(doi.out_refs)}\n" )
+				if g_opts.decls_only:
+					# no references were computed
+					output.write( f"DOI: doi-usr {usr_pool[usr]}: {fmt_oneline_node(doi.node)}\n" )
+				else:
+					output.write( f"DOI: doi-usr {usr_pool[usr]}: {fmt_oneline_node(doi.node)}: in/out {graph.in_count(doi.index)}/{graph.out_count(doi.index)}\n" )
 			for usr,decls in orphan_decls.items():
 				for d in decls:
-					output.write( f"ORPHAN: usr {usr}: {fmt_oneline_node(d)}\n" )
+					output.write( f"ORPHAN: usr {usr_pool[usr]}: {fmt_oneline_node(d)}\n" )
 
 	if g_opts.ref_file:
 		with open(g_opts.ref_file, "w") as output:
+			indexed_dois = list(dois.values())
 			for usr,doi in dois.items():
-				in_ids  = [cursor_id(r.node) for r in doi.in_refs]
-				out_ids = [cursor_id(r.node) for r in doi.out_refs]		
-				output.write( f"DOI: doi-usr {usr}: id {cursor_id(doi.node)}: in-refs {sorted(in_ids)}: out-refs {sorted(out_ids)}\n" )
+				in_ids  = [cursor_id(indexed_dois[r].node) for r in graph.in_refs(doi.index)]
+				out_ids = [cursor_id(indexed_dois[r].node) for r in graph.out_refs(doi.index)]
+				output.write( f"DOI: doi-usr {usr_pool[usr]}: id {cursor_id(doi.node)}: in-refs {sorted(in_ids)}: out-refs {sorted(out_ids)}\n" )
 
 	if g_opts.unused or g_opts.unused_file:
 		unused_output = open(g_opts.unused_file,"w") if g_opts.unused_file else sys.stdout
-		dois_track_unused(dois, unused_output)
+		dois_track_unused(dois, graph, unused_output)
+
+	if g_opts.roots_file:
+		with open(g_opts.roots_file, "w") as output:
+			dois_track_roots(dois, graph, output)
 
 	end_tm = time.time()
 	print( f"Completed in {round(end_tm-start_tm,1)}s" )